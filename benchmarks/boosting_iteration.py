@@ -0,0 +1,71 @@
+"""
+Compares wall time of one GradientBoostingMSE iteration before and after
+the closed-form line search and in-place updates of predictions.
+
+Usage: python benchmarks/boosting_iteration.py [--sizes 10000x20 50000x20] [--n-estimators 20]
+"""
+import sys
+import time
+import argparse
+import numpy as np
+from scipy.optimize import minimize_scalar
+from sklearn.tree import DecisionTreeRegressor
+
+from harness import SRC_DIRECTORY, make_data
+
+sys.path.insert(0, SRC_DIRECTORY)
+from ensembles import GradientBoostingMSE, rmse  # noqa: E402
+
+
+def legacy_fit(X, y, X_val, y_val, n_estimators, learning_rate=0.1, max_depth=5):
+    """
+    The boosting loop as it was before: materialized bootstrap, scipy line search
+    and separate predict calls for the bootstrap sample, train and val sets
+    Returns
+    -------
+    times : list
+        Time from the start after each iteration
+    """
+    n_features = X.shape[1] // 3
+    preds = np.zeros(X.shape[0])
+    pred_val = np.zeros(X_val.shape[0])
+    times = []
+    start = time.time()
+    for _ in range(n_estimators):
+        features_indxes = np.random.choice(np.arange(0, X.shape[1]), size=n_features, replace=False)
+        obj_indexes = np.random.choice(np.arange(0, X.shape[0]), size=X.shape[0], replace=True)
+        tree = DecisionTreeRegressor(max_depth=max_depth)
+        tree.fit(X[obj_indexes][:, features_indxes],
+                 2 * (preds[obj_indexes] - y[obj_indexes]) / X.shape[0])
+        tree_prediction = tree.predict(X[obj_indexes][:, features_indxes])
+        alpha = minimize_scalar(lambda a: np.mean((y[obj_indexes] - preds[obj_indexes]
+                                                   - a * tree_prediction) ** 2)).x
+        preds += learning_rate * alpha * tree.predict(X[:, features_indxes])
+        pred_val += learning_rate * alpha * tree.predict(X_val[:, features_indxes])
+        rmse(y_val, pred_val)
+        rmse(y, preds)
+        times.append(time.time() - start)
+    return times
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--sizes", nargs="+", default=["10000x20", "50000x20", "200000x20"],
+                        help="datasets as n_objectsxn_features")
+    parser.add_argument("--n-estimators", type=int, default=20)
+    args = parser.parse_args()
+    print(f"{'size':>12} {'before, ms/iter':>16} {'after, ms/iter':>16} {'speedup':>8}")
+    for size in args.sizes:
+        n_objects, n_features = map(int, size.split("x"))
+        X, y = make_data(n_objects, n_features)
+        X_val, y_val = make_data(n_objects // 10, n_features, seed=1)
+        np.random.seed(0)
+        before = legacy_fit(X, y, X_val, y_val, args.n_estimators)[-1] / args.n_estimators
+        np.random.seed(0)
+        hist = GradientBoostingMSE(args.n_estimators).fit(X, y, X_val, y_val)
+        after = hist["time"][-1] / args.n_estimators
+        print(f"{size:>12} {before * 1000:>16.1f} {after * 1000:>16.1f} {before / after:>8.2f}")
+
+
+if __name__ == "__main__":
+    main()
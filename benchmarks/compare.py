@@ -0,0 +1,57 @@
+"""
+Compares two results of run_suite.py and reports the cases which became slower or use more memory.
+Exits with code 1 if there are such regressions, so it can be used in CI.
+
+Usage: python benchmarks/compare.py old.json new.json [--threshold 0.1]
+"""
+import sys
+import json
+import argparse
+
+ENSEMBLE_METRICS = ("fit_seconds", "predict_seconds", "fit_peak_mb", "predict_peak_mb", "test_rmse")
+
+
+def metric_cases(results):
+    """
+    Maps the key of each case to its metrics, lower values of all metrics are better
+    """
+    cases = {}
+    for result in results["ensembles"]:
+        key = (f"{result['model']} {result['rows']}x{result['features']} "
+               f"trees={result['n_estimators']} depth={result['max_depth']}")
+        for metric in ENSEMBLE_METRICS:
+            cases[(key, metric)] = result[metric]
+    for result in results["web"]:
+        cases[(f"{result['endpoint']} {result['model']} {result['size']}", "p50_ms")] = result["latency_ms"]["p50"]
+    return cases
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("old")
+    parser.add_argument("new")
+    parser.add_argument("--threshold", type=float, default=0.1,
+                        help="relative increase of a metric which is reported as regression")
+    args = parser.parse_args()
+    with open(args.old) as f:
+        old = metric_cases(json.load(f))
+    with open(args.new) as f:
+        new = metric_cases(json.load(f))
+    regressions = 0
+    print(f"{'case':<50} {'metric':<16} {'old':>10} {'new':>10} {'change':>8}")
+    for key in sorted(old.keys() & new.keys()):
+        old_value, new_value = old[key], new[key]
+        change = (new_value - old_value) / old_value if old_value else 0.0
+        mark = ""
+        if change > args.threshold:
+            mark = " REGRESSION"
+            regressions += 1
+        print(f"{key[0]:<50} {key[1]:<16} {old_value:>10.3f} {new_value:>10.3f} {change:>+8.1%}{mark}")
+    for key in sorted(old.keys() ^ new.keys()):
+        print(f"{key[0]:<50} {key[1]:<16} only in {'old' if key in old else 'new'} results")
+    print(f"{regressions} regressions above {args.threshold:.0%}")
+    sys.exit(1 if regressions else 0)
+
+
+if __name__ == "__main__":
+    main()
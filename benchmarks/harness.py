@@ -0,0 +1,106 @@
+"""
+Helpers shared by the benchmarks: synthetic data, measurements and result files
+"""
+import os
+import sys
+import json
+import time
+import platform
+import subprocess
+import tracemalloc
+import numpy as np
+
+SRC_DIRECTORY = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "src")
+RESULTS_DIRECTORY = os.path.join(os.path.dirname(os.path.abspath(__file__)), "results")
+
+
+def make_data(n_objects, n_features, seed=0):
+    """
+    Synthetic regression data
+    """
+    rng = np.random.RandomState(seed)
+    X = rng.randn(n_objects, n_features)
+    coefs = rng.randn(n_features)
+    y = X @ coefs + np.sin(X[:, 0] * 3) + rng.randn(n_objects) * 0.1
+    return X, y
+
+
+def timed(function, *args, **kwargs):
+    """
+    Calls function and returns its result and wall time
+    """
+    start = time.perf_counter()
+    result = function(*args, **kwargs)
+    return result, time.perf_counter() - start
+
+
+def peak_memory(function, *args, **kwargs):
+    """
+    Calls function with allocations traced, which slows it down, so the call must not be timed
+    Returns
+    -------
+    peak_mb : float
+        Peak memory allocated by python and numpy during the call, allocations of other
+        processes and of compiled code which bypasses python allocator are not counted
+    """
+    tracemalloc.start()
+    try:
+        function(*args, **kwargs)
+        peak = tracemalloc.get_traced_memory()[1]
+    finally:
+        tracemalloc.stop()
+    return peak / 1024 ** 2
+
+
+def latency_summary(seconds):
+    """
+    Summary of latencies of repeated calls in milliseconds
+    """
+    ms = np.asarray(seconds) * 1000
+    return {
+        "n": int(ms.shape[0]),
+        "mean": float(ms.mean()),
+        "p50": float(np.percentile(ms, 50)),
+        "p90": float(np.percentile(ms, 90)),
+        "max": float(ms.max())
+    }
+
+
+def environment():
+    """
+    Describes the machine and the code the benchmark ran on
+    """
+    import sklearn
+    import pandas
+    try:
+        commit = subprocess.run(["git", "rev-parse", "--short", "HEAD"], cwd=SRC_DIRECTORY,
+                                capture_output=True, text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        commit = None
+    return {
+        "time": time.strftime("%Y-%m-%dT%H:%M:%S"),
+        "commit": commit,
+        "python": sys.version.split()[0],
+        "numpy": np.__version__,
+        "pandas": pandas.__version__,
+        "sklearn": sklearn.__version__,
+        "platform": platform.platform(),
+        "cpu_count": os.cpu_count()
+    }
+
+
+def save_results(results, path=None):
+    """
+    Writes results to path or to results/<time>-<commit>.json
+    Returns
+    -------
+    path : str
+    """
+    if path is None:
+        os.makedirs(RESULTS_DIRECTORY, exist_ok=True)
+        meta = results["environment"]
+        name = meta["time"].replace(":", "-") + (f"-{meta['commit']}" if meta["commit"] else "")
+        path = os.path.join(RESULTS_DIRECTORY, name + ".json")
+    with open(path, "w") as f:
+        json.dump(results, f, indent=2)
+    return path
@@ -0,0 +1,220 @@
+"""
+Benchmark suite: fit and predict of the ensembles on a grid of synthetic datasets and
+end-to-end latency of the web endpoints through Flask test client.
+Results are saved as json, compare them with benchmarks/compare.py.
+
+Usage: python benchmarks/run_suite.py [--quick] [--rows 10000 50000] [--features 10 50]
+                                      [--n-estimators 50] [--max-depth 5 10] [--models rf bt bt-hist]
+                                      [--web-sizes 5000x20] [--skip-web] [--skip-ensembles] [--output path]
+"""
+import io
+import os
+import sys
+import time
+import shutil
+import argparse
+import itertools
+import tempfile
+import numpy as np
+import pandas as pd
+
+from harness import SRC_DIRECTORY, make_data, timed, peak_memory, latency_summary, environment, save_results
+
+MODELS = ("rf", "bt", "bt-hist")
+
+
+def make_model(name, n_estimators, max_depth):
+    """
+    Creates ensemble by its short name
+    """
+    from ensembles import RandomForestMSE, GradientBoostingMSE
+    if name == "rf":
+        return RandomForestMSE(n_estimators, max_depth)
+    return GradientBoostingMSE(n_estimators, max_depth=max_depth, histogram=name == "bt-hist")
+
+
+def bench_ensembles(args):
+    """
+    Fits and predicts each model on each dataset of the grid
+    Returns
+    -------
+    results : list
+        One dict per model and dataset
+    """
+    from ensembles import rmse
+    results = []
+    grid = itertools.product(args.rows, args.features, args.n_estimators, args.max_depth)
+    for n_objects, n_features, n_estimators, max_depth in grid:
+        X, y = make_data(n_objects, n_features)
+        X_test, y_test = make_data(n_objects, n_features, seed=1)
+        for name in args.models:
+            fit_times, predict_times = [], []
+            for _ in range(args.repeat):
+                np.random.seed(0)
+                model = make_model(name, n_estimators, max_depth)
+                _, seconds = timed(model.fit, X, y)
+                fit_times.append(seconds)
+                preds, seconds = timed(model.predict, X_test)
+                predict_times.append(seconds)
+            # memory is measured by a separate run, since tracing allocations slows down the timed ones unevenly
+            np.random.seed(0)
+            model = make_model(name, n_estimators, max_depth)
+            fit_peak = peak_memory(model.fit, X, y)
+            predict_peak = peak_memory(model.predict, X_test)
+            result = {
+                "model": name,
+                "rows": n_objects,
+                "features": n_features,
+                "n_estimators": n_estimators,
+                "max_depth": max_depth,
+                "fit_seconds": min(fit_times),
+                "fit_rows_per_second": n_objects / min(fit_times),
+                "fit_peak_mb": fit_peak,
+                "predict_seconds": min(predict_times),
+                "predict_rows_per_second": n_objects / min(predict_times),
+                "predict_peak_mb": predict_peak,
+                "test_rmse": float(rmse(y_test, preds))
+            }
+            results.append(result)
+            print(f"{name:>8} {n_objects:>8}x{n_features:<4} trees={n_estimators:<4} depth={max_depth:<3} "
+                  f"fit {result['fit_seconds']:8.3f}s {result['fit_rows_per_second']:>10.0f} rows/s "
+                  f"{fit_peak:8.1f} MB | predict {result['predict_seconds']:7.3f}s "
+                  f"{result['predict_rows_per_second']:>10.0f} rows/s {predict_peak:8.1f} MB", flush=True)
+    return results
+
+
+def load_web_app(directory):
+    """
+    Imports the application from a copy of src in directory, so that the real database and models are untouched
+    Returns
+    -------
+    client : FlaskClient
+    """
+    app_directory = os.path.join(directory, "src")
+    shutil.copytree(SRC_DIRECTORY, app_directory, ignore=shutil.ignore_patterns("__pycache__"))
+    for subdirectory in ("models", "jobs"):
+        path = os.path.join(app_directory, "instance", subdirectory)
+        for filename in os.listdir(path):
+            if filename != ".gitignore":
+                os.remove(os.path.join(path, filename))
+    database = os.path.join(app_directory, "instance", "database.sqlite")
+    if os.path.exists(database):
+        os.remove(database)
+    sys.path.insert(0, app_directory)
+    from web_server import app, db
+    with app.app_context():
+        db.create_all()
+    return app.test_client()
+
+
+def bench_web(args):
+    """
+    Measures latency of the endpoints for each model type and dataset size
+    Returns
+    -------
+    results : list
+        One dict per endpoint, model and dataset
+    """
+    results = []
+    with tempfile.TemporaryDirectory() as directory:
+        client = load_web_app(directory)
+        for size in args.web_sizes:
+            n_objects, n_features = map(int, size.split("x"))
+            X, y = make_data(n_objects, n_features)
+            columns = [f"f{j}" for j in range(n_features)]
+            train = pd.DataFrame(X, columns=columns).assign(target=y).to_csv(index=False).encode()
+            test = pd.DataFrame(make_data(n_objects, n_features, seed=1)[0], columns=columns)
+            test_csv = test.to_csv(index=False).encode()
+            test_npy = io.BytesIO()
+            np.save(test_npy, test.to_numpy())
+            row = test.iloc[0].tolist()
+            for name in args.models:
+                latencies = {endpoint: [] for endpoint in ("add_model", "fit_model", "fit_model_total", "predict_csv",
+                                                           "predict_npy", "predict_json", "get_info_about_model")}
+                model_name = f"{name}-{size}"
+                for i in range(args.web_repeat):
+                    model = {
+                        "model_type": "rf" if name == "rf" else "bt",
+                        "model_name": f"{model_name}-{i}",
+                        "model_descr": "",
+                        "model_est": str(args.web_n_estimators),
+                        "model_depth": str(args.web_max_depth),
+                        "model_features": "",
+                        "model_lr": "",
+                        "model_histogram": name == "bt-hist"
+                    }
+                    response, seconds = timed(client.post, "/add_model", json=model)
+                    assert response.json[0] == "OK", response.json
+                    latencies["add_model"].append(seconds)
+                # fitting is slow, so only the first web_fit_repeat models are fitted
+                for i in range(args.web_fit_repeat):
+                    form = {"train": (io.BytesIO(train), "train.csv"), "target": "target",
+                            "model": f"{model_name}-{i}", "data_description": ""}
+                    start = time.perf_counter()
+                    response, seconds = timed(client.post, "/fit_model", data=form)
+                    assert response.json[0] == "OK", response.json
+                    latencies["fit_model"].append(seconds)
+                    while True:
+                        status = client.get(f"/get_fit_status?job_id={response.json[1]}").json[1]
+                        if status["state"] != "queued" and status["state"] != "running":
+                            break
+                        time.sleep(0.01)
+                    assert status["state"] == "done", status
+                    latencies["fit_model_total"].append(time.perf_counter() - start)
+                fitted = f"{model_name}-0"
+                for _ in range(args.web_repeat):
+                    form = {"test": (io.BytesIO(test_csv), "test.csv"), "model": fitted, "column_name": "y"}
+                    latencies["predict_csv"].append(timed(client.post, "/predict", data=form)[1])
+                    form = {"test": (io.BytesIO(test_npy.getvalue()), "test.npy"), "model": fitted, "column_name": "y"}
+                    latencies["predict_npy"].append(timed(client.post, "/predict", data=form)[1])
+                    latencies["predict_json"].append(
+                        timed(client.post, "/predict_json", json={"model": fitted, "rows": [row]})[1])
+                    latencies["get_info_about_model"].append(
+                        timed(client.get, f"/get_info_about_model?model_name={fitted}")[1])
+                for endpoint, seconds in latencies.items():
+                    summary = latency_summary(seconds)
+                    results.append({"endpoint": endpoint, "model": name, "size": size, "latency_ms": summary})
+                    print(f"{endpoint:>22} {name:>8} {size:>12} p50 {summary['p50']:9.1f} ms "
+                          f"p90 {summary['p90']:9.1f} ms", flush=True)
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--rows", type=int, nargs="+", default=[10000, 50000])
+    parser.add_argument("--features", type=int, nargs="+", default=[10, 50])
+    parser.add_argument("--n-estimators", type=int, nargs="+", default=[50])
+    parser.add_argument("--max-depth", type=int, nargs="+", default=[5, 10])
+    parser.add_argument("--models", nargs="+", choices=MODELS, default=list(MODELS))
+    parser.add_argument("--repeat", type=int, default=1, help="the best time of this number of runs is reported")
+    parser.add_argument("--web-sizes", nargs="+", default=["5000x20"], help="datasets as n_objectsxn_features")
+    parser.add_argument("--web-n-estimators", type=int, default=50)
+    parser.add_argument("--web-max-depth", type=int, default=6)
+    parser.add_argument("--web-repeat", type=int, default=20, help="the number of calls of fast endpoints")
+    parser.add_argument("--web-fit-repeat", type=int, default=3, help="the number of fittings through the web")
+    parser.add_argument("--skip-ensembles", action="store_true")
+    parser.add_argument("--skip-web", action="store_true")
+    parser.add_argument("--quick", action="store_true", help="small grid for a smoke run")
+    parser.add_argument("--output", help="path of the json file, by default benchmarks/results/<time>-<commit>.json")
+    args = parser.parse_args()
+    if args.quick:
+        args.rows, args.features, args.n_estimators, args.max_depth = [2000], [10], [10], [5]
+        args.web_sizes, args.web_n_estimators, args.web_repeat, args.web_fit_repeat = ["1000x10"], 10, 5, 1
+    args.web_fit_repeat = max(1, min(args.web_fit_repeat, args.web_repeat))
+
+    sys.path.insert(0, SRC_DIRECTORY)
+    results = {
+        "environment": environment(),
+        "arguments": vars(args),
+        "ensembles": [],
+        "web": []
+    }
+    if not args.skip_ensembles:
+        results["ensembles"] = bench_ensembles(args)
+    if not args.skip_web:
+        results["web"] = bench_web(args)
+    print("Results are saved to", save_results(results, args.output))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,127 @@
+import io
+import os
+import zipfile
+import numpy as np
+import pandas as pd
+
+
+# supported formats of the uploaded tables by file extension and by content type
+_EXTENSIONS = {
+    ".csv": "csv",
+    ".npy": "npy",
+    ".npz": "npz",
+    ".parquet": "parquet",
+    ".pq": "parquet",
+    ".arrow": "arrow",
+    ".feather": "arrow"
+}
+_CONTENT_TYPES = {
+    "text/csv": "csv",
+    "application/x-npy": "npy",
+    "application/x-npz": "npz",
+    "application/vnd.apache.parquet": "parquet",
+    "application/x-parquet": "parquet",
+    "application/vnd.apache.arrow.file": "arrow",
+    "application/x-feather": "arrow"
+}
+_MIMETYPES = {
+    "csv": "text/csv",
+    "npy": "application/x-npy",
+    "npz": "application/x-npz",
+    "parquet": "application/vnd.apache.parquet",
+    "arrow": "application/vnd.apache.arrow.file"
+}
+
+
+def upload_format(storage):
+    """
+    Detects format of the uploaded file by its extension, then by its content type. CSV by default
+    storage : werkzeug FileStorage
+    """
+    extension = os.path.splitext(storage.filename or "")[1].lower()
+    if extension in _EXTENSIONS:
+        return _EXTENSIONS[extension]
+    return _CONTENT_TYPES.get(storage.mimetype, "csv")
+
+
+def _array_to_frame(array):
+    """
+    Converts numpy array to DataFrame: fields of structured array become columns,
+    columns of 2d array are named by their indexes
+    """
+    if array.dtype.names is not None:
+        return pd.DataFrame(array)
+    if array.ndim != 2:
+        raise ValueError("Array with features must be two-dimensional")
+    return pd.DataFrame(array, columns=[str(j) for j in range(array.shape[1])], copy=False)
+
+
+def read_table(file, data_format):
+    """
+    Reads uploaded table keeping the types stored in binary formats
+    file : file object
+    data_format : str
+        One of csv, npy, npz, parquet and arrow.
+        npz holds either one-dimensional arrays which are the columns or a single two-dimensional array
+    Returns
+    -------
+    data : pandas DataFrame
+    """
+    try:
+        if data_format == "npy":
+            return _array_to_frame(np.load(file, allow_pickle=False))
+        if data_format == "npz":
+            with np.load(file, allow_pickle=False) as arrays:
+                if len(arrays.files) == 1 and arrays[arrays.files[0]].ndim != 1:
+                    return _array_to_frame(arrays[arrays.files[0]])
+                return pd.DataFrame({name: arrays[name] for name in arrays.files})
+    except (EOFError, zipfile.BadZipFile) as error:
+        raise ValueError(f"Incorrect {data_format} file") from error
+    if data_format == "parquet":
+        return pd.read_parquet(file)
+    if data_format == "arrow":
+        return pd.read_feather(file)
+    return pd.read_csv(file)
+
+
+def write_predictions(preds, column_name, data_format):
+    """
+    Writes predictions as a table with one column in the given binary format
+    Returns
+    -------
+    content : bytes
+    mimetype : str
+    """
+    return write_columns({column_name: preds}, data_format)
+
+
+def write_columns(columns, data_format):
+    """
+    Writes a table in the given format
+    columns : dict
+        Column names and numpy arrays of equal size.
+        npy holds a plain array for a single column and a structured array with named fields otherwise
+    Returns
+    -------
+    content : bytes
+    mimetype : str
+    """
+    buffer = io.BytesIO()
+    if data_format == "npy":
+        if len(columns) == 1:
+            np.save(buffer, next(iter(columns.values())))
+        else:
+            table = np.empty(len(next(iter(columns.values()))),
+                             dtype=[(name, values.dtype) for name, values in columns.items()])
+            for name, values in columns.items():
+                table[name] = values
+            np.save(buffer, table)
+    elif data_format == "npz":
+        np.savez(buffer, **columns)
+    elif data_format == "parquet":
+        pd.DataFrame(columns).to_parquet(buffer, index=False)
+    elif data_format == "arrow":
+        pd.DataFrame(columns).to_feather(buffer)
+    else:
+        pd.DataFrame(columns).to_csv(buffer, index=False)
+    return buffer.getvalue(), _MIMETYPES[data_format]
@@ -1,7 +1,13 @@
+import os
 import time
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from contextlib import nullcontext
+from functools import partial
 import numpy as np
-from scipy.optimize import minimize_scalar
 from sklearn.tree import DecisionTreeRegressor
+from tree_engine import PackedEnsemble, sklearn_tree_arrays
+from histogram import make_bins, bin_features, HistogramTree
+from metrics import stage, record_stage
 
 
 def rmse(y_true, preds):
@@ -15,13 +21,228 @@ def rmse(y_true, preds):
     return np.sqrt(((y_true - preds) ** 2).mean())
 
 
+def _prepare_features(X):
+    """
+    Converts features to float32 column-major array once, which is the layout sklearn trees work with,
+    so neither slicing columns nor fitting a tree makes another conversion
+    """
+    return np.asfortranarray(X, dtype=np.float32)
+
+
+def _select_features(X, features_indxes):
+    """
+    Returns columns of prepared features, without copying if all of them are selected
+    """
+    if features_indxes.shape[0] == X.shape[1] and np.array_equal(features_indxes, np.arange(X.shape[1])):
+        return X
+    return X[:, features_indxes]
+
+
+def _bootstrap_counts(n_objects, random_state=np.random):
+    """
+    Bootstrap sample expressed as the number of times each object is drawn,
+    it is used as sample_weight instead of copying the rows
+    """
+    return np.bincount(random_state.randint(0, n_objects, size=n_objects), minlength=n_objects)
+
+
+def _eval_rows(n_objects, eval_subsample):
+    """
+    Draws fixed random subsample of train objects on which train loss is computed
+    eval_subsample : float or int
+        Fraction of the objects if float, their number if int. None means all objects
+    Returns
+    -------
+    rows : numpy ndarray
+        Sorted indexes of the objects or None for all objects
+    """
+    if eval_subsample is None:
+        return None
+    if isinstance(eval_subsample, float):
+        eval_subsample = int(eval_subsample * n_objects)
+    if eval_subsample >= n_objects:
+        return None
+    return np.sort(np.random.choice(n_objects, size=max(eval_subsample, 1), replace=False))
+
+
+def _is_eval_iteration(iteration, last_iteration, eval_period):
+    """
+    Losses are computed after each eval_period-th tree and after the last tree
+    """
+    return (iteration + 1) % eval_period == 0 or iteration == last_iteration
+
+
+class _EarlyStopping:
+    """
+    Tracks validation loss and tells when it has not improved for several iterations
+    """
+    def __init__(self, patience, tol=0.0):
+        """
+        patience : int
+            The number of iterations without improvement after which fitting stops
+        tol : float
+            Minimal decrease of the loss counted as improvement
+        """
+        self.patience = patience
+        self.tol = tol
+        self.best_loss = np.inf
+        self.best_iteration = None
+
+    def update(self, iteration, loss):
+        """
+        Returns True if fitting should stop
+        """
+        if loss < self.best_loss - self.tol:
+            self.best_loss = loss
+            self.best_iteration = iteration
+        return iteration - self.best_iteration >= self.patience
+
+
+def _continued_hist(hist, n_trees):
+    """
+    Copies fitting history of the model with n_trees trees, so that it can be extended by new trees.
+    Iterations dropped by early stopping are removed
+    """
+    result = {
+        "time": [],
+        "train-loss": []
+    }
+    for key in ("time", "train-loss", "val-loss", "oob-loss"):
+        if hist and key in hist:
+            result[key] = list(hist[key][:n_trees])
+    return result
+
+
+def _align_val_loss(hist, n_iterations, has_val):
+    """
+    Pads val loss with None for the iterations fitted without val set, so that it matches train loss
+    """
+    val_loss = hist.get("val-loss", [])
+    if not (has_val or val_loss):
+        return
+    if has_val:
+        hist["val-loss"] = [None] * (n_iterations - len(val_loss)) + val_loss
+    else:
+        val_loss.extend([None] * (n_iterations - len(val_loss)))
+
+
+_worker_data = {}
+
+
+def _init_worker(data):
+    """
+    Stores data shared by all tasks of a worker process
+    """
+    _worker_data.update(data)
+
+
+def _effective_n_jobs(n_jobs):
+    """
+    Converts n_jobs parameter to the number of workers
+    """
+    if n_jobs is None:
+        return 1
+    if n_jobs < 0:
+        return max(os.cpu_count() + 1 + n_jobs, 1)
+    return max(n_jobs, 1)
+
+
+def _make_executor(n_jobs, backend, data):
+    """
+    Creates pool of workers for the given backend or empty context if n_jobs is 1
+    data : dict
+           Arrays which are sent to each worker process once instead of each task
+    """
+    n_workers = _effective_n_jobs(n_jobs)
+    if n_workers == 1:
+        return nullcontext()
+    if backend == "threads":
+        return ThreadPoolExecutor(max_workers=n_workers)
+    return ProcessPoolExecutor(max_workers=n_workers, initializer=_init_worker, initargs=(data,))
+
+
+def _fit_forest_tree(seed, data=None):
+    """
+    Fits one tree of the random forest on its own bootstrap sample
+    seed : int
+           Seed of the bootstrap sample, feature subset and the tree itself
+    Returns
+    -------
+    tree, features indexes, out-of-bag objects with their predictions, durations of the stages
+    and the time of finishing. Train and val predictions are made by the caller for blocks of trees
+    """
+    if data is None:
+        data = _worker_data
+    X, y = data["X"], data["y"]
+    rng = np.random.RandomState(seed)
+    counts = _bootstrap_counts(X.shape[0], rng)
+    features_indxes = np.sort(rng.choice(X.shape[1], size=data["n_features"], replace=False))
+    trees_parameters = dict(data["trees_parameters"])
+    trees_parameters.setdefault("random_state", seed)
+    tree = DecisionTreeRegressor(max_depth=data["max_depth"], **trees_parameters)
+    X_features = _select_features(X, features_indxes)
+    start = time.perf_counter()
+    tree.fit(X_features, y, sample_weight=counts)
+    fitted = time.perf_counter()
+    oob = None
+    if data["oob"]:
+        # objects which are not in the bootstrap sample
+        oob_rows = np.flatnonzero(counts == 0)
+        oob = oob_rows, tree.predict(X_features[oob_rows])
+    # stages are recorded by the caller, since the tree may be fitted in another process
+    stages = [("fit_tree", fitted - start), ("predict_tree", time.perf_counter() - fitted)]
+    return tree, features_indxes, oob, stages, time.time()
+
+
+# with a time budget trees are evaluated in this number of blocks, the budget is checked between the blocks
+_BUDGET_BLOCKS = 16
+
+
+def _check_predict_limits(max_trees, time_budget):
+    """
+    Raises ValueError if the limits of prediction are not positive
+    """
+    if max_trees is not None and max_trees <= 0:
+        raise ValueError("max_trees must be positive")
+    if time_budget is not None and time_budget <= 0:
+        raise ValueError("time_budget must be positive")
+
+
+def _staged_engine_predict(engine, X, step, mean):
+    """
+    Yields the number of trees and predictions of the first trees after each step trees
+    mean : bool
+        If True, the ensemble averages its trees, so the sum of the first trees is rescaled to their mean
+    """
+    for n_trees, preds in engine.staged_predict(X, step):
+        if mean:
+            preds *= engine.n_trees / n_trees
+        yield n_trees, preds
+
+
+def _predict_within_budget(engine, X, time_budget, mean):
+    """
+    Evaluates blocks of the trees while the next block is expected to fit into time_budget seconds
+    The first block is always evaluated
+    """
+    start = time.perf_counter()
+    step = max(1, -(-engine.n_trees // _BUDGET_BLOCKS))
+    preds = np.zeros(X.shape[0])
+    for i, (_, preds) in enumerate(_staged_engine_predict(engine, X, step, mean), 1):
+        # the next block is expected to take as long as the average one
+        if (time.perf_counter() - start) * (i + 1) / i > time_budget:
+            break
+    return preds
+
+
 class RandomForestMSE:
     """
     RandomForestRegressor for MSE metric
     """
     def __init__(
         self, n_estimators, max_depth=None, feature_subsample_size=None,
-        **trees_parameters
+        n_jobs=None, backend="threads", early_stopping_rounds=None, tol=0.0,
+        eval_period=1, eval_subsample=None, oob_loss=False, **trees_parameters
     ):
         """
         n_estimators : int
@@ -30,16 +251,100 @@ class RandomForestMSE:
             The maximum depth of the tree. If None then there is no limits.
         feature_subsample_size : float
             The size of feature set for each tree. If None then use one-third of all features.
+        n_jobs : int
+            The number of trees fitted and evaluated concurrently. None or 1 means no parallelism,
+            -1 means using all processors.
+        backend : str
+            "threads" or "processes": which kind of workers fits the trees when n_jobs is not 1.
+            Prediction always uses threads, since the trees are traversed by code which releases GIL
+        early_stopping_rounds : int
+            If val set is given, fitting stops when val loss has not improved for this number of trees
+            and the model is truncated to the best iteration. If None then all trees are fitted.
+        tol : float
+            Minimal decrease of val loss counted as improvement for early stopping.
+        eval_period : int
+            Losses are computed after each eval_period-th tree and after the last one, in the other iterations
+            hist has None. Early stopping checks only these iterations.
+        eval_subsample : float or int
+            Fraction (float) or number (int) of train objects, fixed for the whole fitting, on which train loss
+            is computed. If None then all train objects are used.
+        oob_loss : bool
+            If True, out-of-bag loss is added to hist. Each object is predicted by the trees which did not
+            have it in their bootstrap sample. It is computed only when the forest is fitted from scratch.
         """
-        self.__estimators = [DecisionTreeRegressor(max_depth=max_depth, **trees_parameters)
-                             for _ in range(n_estimators)]
+        if backend not in ("threads", "processes"):
+            raise ValueError("backend must be 'threads' or 'processes'")
         self.__n_estimators = n_estimators
         self.__max_depth = max_depth
         self.__feature_subsample_size = feature_subsample_size
+        self.__n_jobs = n_jobs
+        self.__backend = backend
+        self.__early_stopping_rounds = early_stopping_rounds
+        self.__tol = tol
+        self.__eval_period = eval_period
+        self.__eval_subsample = eval_subsample
+        self.__oob_loss = oob_loss
         self.__trees_parameters = trees_parameters
-        self.__features = None
+        self.__engine = None
 
-    def fit(self, X, y, X_val=None, y_val=None):
+    def __setstate__(self, state):
+        """
+        Restores pickled forest, packing trees of the models saved as sklearn trees
+        """
+        self.__n_jobs = None
+        self.__backend = "threads"
+        self.__early_stopping_rounds = None
+        self.__tol = 0.0
+        self.__eval_period = 1
+        self.__eval_subsample = None
+        self.__oob_loss = False
+        self.__engine = None
+        self.__dict__.update(state)
+        estimators = self.__dict__.pop("_RandomForestMSE__estimators", None)
+        features = self.__dict__.pop("_RandomForestMSE__features", None)
+        if self.__engine is None and features:
+            self.__engine = PackedEnsemble.from_sklearn(estimators, features, [1 / len(features)] * len(features))
+
+    @classmethod
+    def from_packed(cls, params, engine):
+        """
+        Creates the forest from its params and packed trees, e.g. read from the native model file
+        params : dict
+            Params returned by get_params(deep=True)
+        engine : PackedEnsemble
+            Trees of the fitted forest or None if it is not fitted
+        """
+        params = dict(params)
+        model = cls(**params.pop("trees_params", {}), **params)
+        model.__engine = engine
+        return model
+
+    def __pack(self, trees):
+        """
+        Appends new trees to the packed ones, rescaling the old trees so that all trees have equal weights
+        """
+        n_fitted = self.n_trees
+        n_total = n_fitted + len(trees)
+        engines = [PackedEnsemble.from_trees(trees, [1 / n_total] * len(trees) if trees else [])]
+        if n_fitted:
+            engines.insert(0, self.__engine.scaled(n_fitted / n_total))
+        self.__engine = PackedEnsemble.concatenate(engines)
+
+    @property
+    def engine(self):
+        """
+        Packed trees of the fitted forest or None
+        """
+        return self.__engine
+
+    @property
+    def n_trees(self):
+        """
+        The number of fitted trees
+        """
+        return self.__engine.n_trees if self.__engine is not None else 0
+
+    def fit(self, X, y, X_val=None, y_val=None, callback=None):
         """
         X : numpy ndarray
             Array of size n_objects, n_features
@@ -49,53 +354,166 @@ class RandomForestMSE:
             Array of size n_val_objects, n_features
         y_val : numpy ndarray
             Array of size n_val_objects
+        callback : callable
+            Called with hist after each tree. If it returns True, fitting stops
+        Returns
+        -------
+        hist : dict
+            Time, train loss, val loss and out-of-bag loss if it is enabled after each tree,
+            best-iteration is added if the model was truncated by early stopping
         """
-        n_features = 0
-        self.__features = []
-        if self.__feature_subsample_size is None:
-            n_features = X.shape[1] // 3
-        else:
-            n_features = int(X.shape[1] * self.__feature_subsample_size)
+        self.__engine = None
         hist = {
             "time": [],
             "train-loss": [],
             "val-loss": []
         }
-        if not (X_val is None or y_val is None):
-            hist["val-loss"] = []
-            prev_pred = np.zeros(X_val.shape[0])
-        prev_pred_train = np.zeros(X.shape[0])
-        start = time.time()
-        for i in range(self.__n_estimators):
-            elements_indxes = np.random.choice(np.arange(0, X.shape[0]), size=X.shape[0], replace=True)
-            features_indxes = np.random.choice(np.arange(0, X.shape[1]), size=n_features, replace=False)
-            self.__estimators[i].fit(X[elements_indxes][:, features_indxes], y[elements_indxes])
-            self.__features.append(features_indxes)
-            if not (X_val is None or y_val is None):
-                prev_pred = (prev_pred * i +
-                             self.__estimators[i].predict(X_val[:, features_indxes])) / (i + 1)
-                hist["val-loss"].append(rmse(y_val, prev_pred))
-            prev_pred_train = (prev_pred_train * i +
-                                self.__estimators[i].predict(X[:, features_indxes])) / (i + 1)
-            hist["time"].append(time.time() - start)
-            hist["train-loss"].append(rmse(y, prev_pred_train))
-        if not (X_val is None or y_val is None):
-            return hist
-        return self
+        if self.__oob_loss:
+            hist["oob-loss"] = []
+        return self.__grow(X, y, X_val, y_val, self.__n_estimators, hist, callback)
+
+    def continue_fit(self, X, y, n_estimators, X_val=None, y_val=None, hist=None, callback=None):
+        """
+        Adds trees to the fitted forest, updating the running average of its predictions
+        n_estimators : int
+            The number of new trees
+        hist : dict
+            History of the previous fitting, it is extended by the new trees
+        Other parameters are the same as in fit
+        """
+        hist = _continued_hist(hist, self.n_trees)
+        self.__n_estimators = self.n_trees + n_estimators
+        return self.__grow(X, y, X_val, y_val, n_estimators, hist, callback)
+
+    def __grow(self, X, y, X_val, y_val, n_new, hist, callback):
+        """
+        Fits n_new trees in addition to the current ones and extends hist
+        """
+        if self.__feature_subsample_size is None:
+            n_features = X.shape[1] // 3
+        else:
+            n_features = int(X.shape[1] * self.__feature_subsample_size)
+        n_fitted = self.n_trees
+        has_val = not (X_val is None or y_val is None)
+        _align_val_loss(hist, n_fitted, has_val)
+        # sums of the predictions of the evaluated trees, new trees are added by blocks at the eval iterations
+        if has_val:
+            X_val = np.ascontiguousarray(X_val, dtype=np.float32)
+            val_sum = self.predict(X_val) * n_fitted if n_fitted else np.zeros(X_val.shape[0])
+        eval_rows = _eval_rows(X.shape[0], self.__eval_subsample)
+        X_eval = np.ascontiguousarray(X if eval_rows is None else X[eval_rows], dtype=np.float32)
+        y_eval = y if eval_rows is None else y[eval_rows]
+        train_sum = self.predict(X_eval) * n_fitted if n_fitted else np.zeros(X_eval.shape[0])
+        # out-of-bag predictions of the previous trees are unknown, so it is computed only from scratch
+        compute_oob = self.__oob_loss and n_fitted == 0
+        if compute_oob:
+            oob_sum = np.zeros(X.shape[0])
+            oob_count = np.zeros(X.shape[0])
+        # seeds are drawn before any tree is fitted, so the forest does not depend on n_jobs
+        seeds = np.random.randint(np.iinfo(np.int32).max, size=n_new)
+        data = {
+            "X": _prepare_features(X),
+            "y": y,
+            "oob": compute_oob,
+            "n_features": n_features,
+            "max_depth": self.__max_depth,
+            "trees_parameters": self.__trees_parameters
+        }
+        stopping = None
+        if self.__early_stopping_rounds and has_val:
+            stopping = _EarlyStopping(self.__early_stopping_rounds, self.__tol)
+            if n_fitted:
+                stopping.update(n_fitted - 1, rmse(y_val, val_sum / n_fitted))
+        start = time.time() - (hist["time"][-1] if hist["time"] else 0)
+        last_finish = start
+        trees = []
+        n_evaluated = n_fitted
+        with _make_executor(self.__n_jobs, self.__backend, data) as executor:
+            if executor is None:
+                results = (_fit_forest_tree(seed, data) for seed in seeds)
+            elif self.__backend == "threads":
+                results = executor.map(partial(_fit_forest_tree, data=data), seeds)
+            else:
+                results = executor.map(_fit_forest_tree, seeds)
+            for i, (tree, features_indxes, oob, stages, finish) in enumerate(results, n_fitted):
+                for name, seconds in stages:
+                    record_stage(name, seconds)
+                trees.append(sklearn_tree_arrays(tree, features_indxes))
+                is_eval = _is_eval_iteration(i, n_fitted + n_new - 1, self.__eval_period)
+                if is_eval:
+                    # the trees fitted since the previous eval iteration are evaluated at once
+                    with stage("predict_tree"):
+                        block = PackedEnsemble.from_trees(trees[n_evaluated - n_fitted:], [1.0] * (i + 1 - n_evaluated))
+                        if has_val:
+                            val_sum += block.predict(X_val)
+                        train_sum += block.predict(X_eval)
+                    n_evaluated = i + 1
+                with stage("eval"):
+                    if has_val:
+                        hist["val-loss"].append(rmse(y_val, val_sum / (i + 1)) if is_eval else None)
+                    if compute_oob:
+                        oob_sum[oob[0]] += oob[1]
+                        oob_count[oob[0]] += 1
+                        covered = oob_count > 0
+                        hist["oob-loss"].append(rmse(y[covered], oob_sum[covered] / oob_count[covered])
+                                                if is_eval and covered.any() else None)
+                    hist["train-loss"].append(rmse(y_eval, train_sum / (i + 1)) if is_eval else None)
+                last_finish = max(last_finish, finish)
+                hist["time"].append(last_finish - start)
+                stop = stopping is not None and is_eval and stopping.update(i, hist["val-loss"][-1])
+                if (callback is not None and callback(hist)) or stop:
+                    if executor is not None:
+                        executor.shutdown(cancel_futures=True)
+                    break
+        if stopping is not None:
+            del trees[stopping.best_iteration + 1 - n_fitted:]
+            hist["best-iteration"] = stopping.best_iteration
+        _align_val_loss(hist, len(hist["time"]), has_val)
+        if "oob-loss" in hist:
+            hist["oob-loss"].extend([None] * (len(hist["time"]) - len(hist["oob-loss"])))
+        self.__pack(trees)
+        return hist
 
-    def predict(self, X):
+    def predict(self, X, max_trees=None, time_budget=None):
         """
         X : numpy ndarray
             Array of size n_objects, n_features
+        max_trees : int
+            If given, only the first max_trees trees are averaged. Fewer trees are proportionally faster
+            and less accurate, the loss of each number of trees is shown by the fitting history
+        time_budget : float
+            If given, trees are evaluated by blocks in one thread until the next block is expected
+            to exceed this number of seconds
         Returns
         -------
         y : numpy ndarray
             Array of size n_objects
         """
-        preds = np.zeros(X.shape[0])
-        for i in range(self.__n_estimators):
-            preds += self.__estimators[i].predict(X[:, self.__features[i]])
-        return preds / self.__n_estimators
+        _check_predict_limits(max_trees, time_budget)
+        engine = self.__engine
+        if max_trees is not None and max_trees < engine.n_trees:
+            engine = engine.prefix(max_trees).scaled(engine.n_trees / max_trees)
+        n_jobs = _effective_n_jobs(self.__n_jobs)
+        with stage("predict"):
+            if time_budget is not None and engine.n_trees > 0:
+                return _predict_within_budget(engine, X, time_budget, mean=True)
+            if n_jobs == 1 or X.shape[0] < 2:
+                return engine.predict(X)
+            # processes would receive copies of X and of all trees on each call, threads share them
+            blocks = np.array_split(np.arange(X.shape[0]), min(n_jobs, X.shape[0]))
+            with ThreadPoolExecutor(max_workers=len(blocks)) as executor:
+                return np.concatenate(list(executor.map(lambda rows: engine.predict(X[rows]), blocks)))
+
+    def staged_predict(self, X, step=1):
+        """
+        Yields predictions of the first trees after each step trees, the last one uses all trees
+        X : numpy ndarray
+            Array of size n_objects, n_features
+        step : int
+            The number of trees added between the predictions
+        """
+        for _, preds in _staged_engine_predict(self.__engine, X, step, mean=True):
+            yield preds
 
     def get_params(self, deep=True):
         """
@@ -106,7 +524,14 @@ class RandomForestMSE:
         params = {
             "n_estimators": self.__n_estimators,
             "feature_subsample_size": self.__feature_subsample_size,
-            "max_depth": self.__max_depth
+            "max_depth": self.__max_depth,
+            "n_jobs": self.__n_jobs,
+            "backend": self.__backend,
+            "early_stopping_rounds": self.__early_stopping_rounds,
+            "tol": self.__tol,
+            "eval_period": self.__eval_period,
+            "eval_subsample": self.__eval_subsample,
+            "oob_loss": self.__oob_loss
         }
         if deep:
             params["trees_params"] = self.__trees_parameters
@@ -119,7 +544,8 @@ class GradientBoostingMSE:
     """
     def __init__(
         self, n_estimators, learning_rate=0.1, max_depth=5, feature_subsample_size=None,
-        **trees_parameters
+        histogram=False, max_bins=255, early_stopping_rounds=None, tol=0.0,
+        eval_period=1, eval_subsample=None, **trees_parameters
     ):
         """
         n_estimators : int
@@ -130,74 +556,276 @@ class GradientBoostingMSE:
             The maximum depth of the tree. If None then there is no limits.
         feature_subsample_size : float
             The size of feature set for each tree. If None then use one-third of all features.
+        histogram : bool
+            If True, features are quantized into bins once and trees are grown on histograms.
+            Only min_samples_leaf of trees_parameters is used in this mode.
+        max_bins : int
+            The maximum number of bins of each feature in histogram mode, at most 256.
+        early_stopping_rounds : int
+            If val set is given, fitting stops when val loss has not improved for this number of trees
+            and the model is truncated to the best iteration. If None then all trees are fitted.
+        tol : float
+            Minimal decrease of val loss counted as improvement for early stopping.
+        eval_period : int
+            Losses are computed after each eval_period-th tree and after the last one, in the other iterations
+            hist has None. Early stopping checks only these iterations.
+        eval_subsample : float or int
+            Fraction (float) or number (int) of train objects, fixed for the whole fitting, on which train loss
+            is computed. If None then all train objects are used.
         """
-        self.__estimators = [DecisionTreeRegressor(max_depth=max_depth, **trees_parameters)
-                             for _ in range(n_estimators)]
         self.__lr = learning_rate
         self.__n_estimators = n_estimators
         self.__max_depth = max_depth
         self.__feature_subsample_size = feature_subsample_size
+        self.__histogram = histogram
+        self.__max_bins = max_bins
+        self.__early_stopping_rounds = early_stopping_rounds
+        self.__tol = tol
+        self.__eval_period = eval_period
+        self.__eval_subsample = eval_subsample
         self.__trees_parameters = trees_parameters
-        self.__features = None
-        self.__coefs = None
+        self.__engine = None
+
+    def __setstate__(self, state):
+        """
+        Restores pickled boosting, packing trees of the models saved as sklearn trees
+        """
+        self.__histogram = False
+        self.__max_bins = 255
+        self.__early_stopping_rounds = None
+        self.__tol = 0.0
+        self.__eval_period = 1
+        self.__eval_subsample = None
+        self.__engine = None
+        self.__dict__.update(state)
+        estimators = self.__dict__.pop("_GradientBoostingMSE__estimators", None)
+        features = self.__dict__.pop("_GradientBoostingMSE__features", None)
+        coefs = self.__dict__.pop("_GradientBoostingMSE__coefs", None)
+        if self.__engine is None and features:
+            weights = [self.__lr * coef for coef in coefs]
+            if self.__histogram:
+                self.__engine = PackedEnsemble.from_trees([tree.arrays() for tree in estimators], weights)
+            else:
+                self.__engine = PackedEnsemble.from_sklearn(estimators, features, weights)
+
+    @classmethod
+    def from_packed(cls, params, engine):
+        """
+        Creates the boosting from its params and packed trees, e.g. read from the native model file
+        params : dict
+            Params returned by get_params(deep=True)
+        engine : PackedEnsemble
+            Trees of the fitted boosting or None if it is not fitted
+        """
+        params = dict(params)
+        model = cls(**params.pop("trees_params", {}), **params)
+        model.__engine = engine
+        return model
 
-    def __mse_loss_target(self, y_true, preds):
-        return 2 * (preds - y_true) / preds.shape[0]
+    def __pack(self, trees, weights):
+        """
+        Appends new trees to the packed ones
+        """
+        engines = [PackedEnsemble.from_trees(trees, weights)]
+        if self.n_trees:
+            engines.insert(0, self.__engine)
+        self.__engine = PackedEnsemble.concatenate(engines)
+
+    def __line_search(self, residual, tree_prediction, counts):
+        """
+        Returns alpha minimizing MSE of residual - alpha * tree_prediction on the bootstrap sample,
+        for MSE the minimum has closed form
+        """
+        weighted = counts * tree_prediction
+        denominator = np.dot(weighted, tree_prediction)
+        if denominator == 0:
+            return 0.0
+        return np.dot(weighted, residual) / denominator
 
-    def fit(self, X, y, X_val=None, y_val=None):
+    @property
+    def engine(self):
+        """
+        Packed trees of the fitted boosting or None
+        """
+        return self.__engine
+
+    @property
+    def n_trees(self):
+        """
+        The number of fitted trees
+        """
+        return self.__engine.n_trees if self.__engine is not None else 0
+
+    def fit(self, X, y, X_val=None, y_val=None, callback=None):
         """
         X : numpy ndarray
             Array of size n_objects, n_features
         y : numpy ndarray
             Array of size n_objects
+        X_val : numpy ndarray
+            Array of size n_val_objects, n_features
+        y_val : numpy ndarray
+            Array of size n_val_objects
+        callback : callable
+            Called with hist after each tree. If it returns True, fitting stops
+        Returns
+        -------
+        hist : dict
+            Time, train loss and val loss after each tree,
+            best-iteration is added if the model was truncated by early stopping
         """
-        n_features = 0
-        self.__features = []
-        self.__coefs = []
-        if self.__feature_subsample_size is None:
-            n_features = X.shape[1] // 3
-        else:
-            n_features = int(X.shape[1] * self.__feature_subsample_size)
+        self.__engine = None
         hist = {
             "time": [],
             "train-loss": []
         }
-        if not (X_val is None or y_val is None):
-            hist["val-loss"] = []
-            pred_val = np.zeros(X_val.shape[0])
-        preds = np.zeros(X.shape[0])
-        start = time.time()
-        for i in range(self.__n_estimators):
-            features_indxes = np.random.choice(np.arange(0, X.shape[1]), size=n_features, replace=False)
-            obj_indexes = np.random.choice(np.arange(0, X.shape[0]), size=X.shape[0], replace=True)
-            self.__estimators[i].fit(X[obj_indexes][:, features_indxes],
-                                     self.__mse_loss_target(y[obj_indexes], preds[obj_indexes]))
-            tree_prediction = self.__estimators[i].predict(X[obj_indexes][:, features_indxes])
-            alpha = minimize_scalar(lambda a: np.mean((y[obj_indexes] - preds[obj_indexes]
-                                                       - a * tree_prediction) ** 2)).x
-            preds += self.__lr * alpha * self.__estimators[i].predict(X[:, features_indxes])
-            self.__coefs.append(alpha)
-            self.__features.append(features_indxes)
-            if not (X_val is None or y_val is None):
-                pred_val += self.__lr * alpha * self.__estimators[i].predict(X_val[:, features_indxes])
-                hist["val-loss"].append(rmse(y_val, pred_val))
+        return self.__grow(X, y, X_val, y_val, self.__n_estimators, hist, callback)
+
+    def continue_fit(self, X, y, n_estimators, X_val=None, y_val=None, hist=None, callback=None):
+        """
+        Adds trees to the fitted boosting, starting from the residuals of the current model
+        n_estimators : int
+            The number of new trees
+        hist : dict
+            History of the previous fitting, it is extended by the new trees
+        Other parameters are the same as in fit
+        """
+        hist = _continued_hist(hist, self.n_trees)
+        self.__n_estimators = self.n_trees + n_estimators
+        return self.__grow(X, y, X_val, y_val, n_estimators, hist, callback)
+
+    def __grow(self, X, y, X_val, y_val, n_new, hist, callback):
+        """
+        Fits n_new trees in addition to the current ones and extends hist
+        """
+        if self.__feature_subsample_size is None:
+            n_features = X.shape[1] // 3
+        else:
+            n_features = int(X.shape[1] * self.__feature_subsample_size)
+        n_fitted = self.n_trees
+        has_val = not (X_val is None or y_val is None)
+        _align_val_loss(hist, n_fitted, has_val)
+        if has_val:
+            # y_val - predictions on val set, updated in place
+            residual_val = np.array(y_val, dtype=np.float64)
+            if n_fitted:
+                residual_val -= self.predict(X_val)
+            val_buffer = np.empty(X_val.shape[0])
+        # y - predictions on train set, updated in place as well as buffers reused by all iterations
+        residual = np.array(y, dtype=np.float64)
+        if n_fitted:
+            residual -= self.predict(X)
+        eval_rows = _eval_rows(X.shape[0], self.__eval_subsample)
+        target = np.empty(X.shape[0])
+        train_buffer = np.empty(X.shape[0])
+        stopping = None
+        if self.__early_stopping_rounds and has_val:
+            stopping = _EarlyStopping(self.__early_stopping_rounds, self.__tol)
+            if n_fitted:
+                stopping.update(n_fitted - 1, np.sqrt(np.dot(residual_val, residual_val) / residual_val.shape[0]))
+        start = time.time() - (hist["time"][-1] if hist["time"] else 0)
+        if self.__histogram:
+            # features are binned once and the binned matrices are reused by all iterations
+            with stage("binning"):
+                edges = make_bins(X, self.__max_bins)
+                X_binned = bin_features(X, edges)
+                if has_val:
+                    X_val_binned = bin_features(X_val, edges)
+        else:
+            X_prepared = _prepare_features(X)
+            if has_val:
+                X_val_prepared = _prepare_features(X_val)
+        trees = []
+        weights = []
+        for i in range(n_fitted, n_fitted + n_new):
+            features_indxes = np.sort(np.random.choice(X.shape[1], size=n_features, replace=False))
+            counts = _bootstrap_counts(X.shape[0])
+            np.multiply(residual, -2 / X.shape[0], out=target)
+            if self.__histogram:
+                with stage("fit_tree"):
+                    tree = HistogramTree(self.__max_depth, self.__trees_parameters.get("min_samples_leaf", 1))
+                    tree.fit(X_binned, target, counts, features_indxes, edges)
+                with stage("predict_tree"):
+                    leaves = tree.apply_binned(X_binned)
+                values = tree.value
+                tree_arrays = tree.arrays()
+            else:
+                X_features = _select_features(X_prepared, features_indxes)
+                with stage("fit_tree"):
+                    tree = DecisionTreeRegressor(max_depth=self.__max_depth, **self.__trees_parameters)
+                    tree.fit(X_features, target, sample_weight=counts)
+                with stage("predict_tree"):
+                    leaves = tree.apply(X_features)
+                values = tree.tree_.value[:, 0, 0]
+                tree_arrays = sklearn_tree_arrays(tree, features_indxes)
+            with stage("line_search"):
+                np.take(values, leaves, out=train_buffer)
+                alpha = self.__line_search(residual, train_buffer, counts)
+                # the step is applied to leaf values, so predictions are updated without new arrays
+                step = self.__lr * alpha * values
+                residual -= np.take(step, leaves, out=train_buffer)
+            trees.append(tree_arrays)
+            weights.append(self.__lr * alpha)
+            if has_val:
+                with stage("predict_tree"):
+                    if self.__histogram:
+                        leaves_val = tree.apply_binned(X_val_binned)
+                    else:
+                        leaves_val = tree.apply(_select_features(X_val_prepared, features_indxes))
+                    residual_val -= np.take(step, leaves_val, out=val_buffer)
+            is_eval = _is_eval_iteration(i, n_fitted + n_new - 1, self.__eval_period)
+            with stage("eval"):
+                if has_val:
+                    hist["val-loss"].append(np.sqrt(np.dot(residual_val, residual_val) / residual_val.shape[0])
+                                            if is_eval else None)
+                if not is_eval:
+                    hist["train-loss"].append(None)
+                else:
+                    residual_eval = residual if eval_rows is None else residual[eval_rows]
+                    hist["train-loss"].append(np.sqrt(np.dot(residual_eval, residual_eval) / residual_eval.shape[0]))
             hist["time"].append(time.time() - start)
-            hist["train-loss"].append(rmse(y, preds))
+            stop = stopping is not None and is_eval and stopping.update(i, hist["val-loss"][-1])
+            if (callback is not None and callback(hist)) or stop:
+                break
+        if stopping is not None:
+            del trees[stopping.best_iteration + 1 - n_fitted:]
+            del weights[stopping.best_iteration + 1 - n_fitted:]
+            hist["best-iteration"] = stopping.best_iteration
+        _align_val_loss(hist, len(hist["time"]), has_val)
+        self.__pack(trees, weights)
         return hist
 
-    def predict(self, X):
+    def predict(self, X, max_trees=None, time_budget=None):
         """
         X : numpy ndarray
             Array of size n_objects, n_features
+        max_trees : int
+            If given, only the first max_trees trees are summed. Fewer trees are proportionally faster
+            and less accurate, the loss of each number of trees is shown by the fitting history
+        time_budget : float
+            If given, trees are evaluated by blocks until the next block is expected to exceed this number of seconds
         Returns
         -------
         y : numpy ndarray
             Array of size n_objects
         """
-        preds = np.zeros(X.shape[0])
-        for i in range(self.__n_estimators):
-            preds += self.__lr * self.__coefs[i] * self.__estimators[i].predict(X[:, self.__features[i]])
-        return preds
+        _check_predict_limits(max_trees, time_budget)
+        engine = self.__engine if max_trees is None else self.__engine.prefix(max_trees)
+        with stage("predict"):
+            if time_budget is not None and engine.n_trees > 0:
+                return _predict_within_budget(engine, X, time_budget, mean=False)
+            return engine.predict(X)
+
+    def staged_predict(self, X, step=1):
+        """
+        Yields predictions of the first trees after each step trees, the last one uses all trees
+        X : numpy ndarray
+            Array of size n_objects, n_features
+        step : int
+            The number of trees added between the predictions
+        """
+        for _, preds in _staged_engine_predict(self.__engine, X, step, mean=False):
+            yield preds
 
     def get_params(self, deep=True):
         """
@@ -209,7 +837,13 @@ class GradientBoostingMSE:
             "n_estimators": self.__n_estimators,
             "learning_rate": self.__lr,
             "feature_subsample_size": self.__feature_subsample_size,
-            "max_depth": self.__max_depth
+            "max_depth": self.__max_depth,
+            "histogram": self.__histogram,
+            "max_bins": self.__max_bins,
+            "early_stopping_rounds": self.__early_stopping_rounds,
+            "tol": self.__tol,
+            "eval_period": self.__eval_period,
+            "eval_subsample": self.__eval_subsample
         }
         if deep:
             params["trees_params"] = self.__trees_parameters
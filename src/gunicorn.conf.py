@@ -0,0 +1,26 @@
+"""
+Configuration of the production server, run it as
+    gunicorn -c gunicorn.conf.py web_server:app
+The application is imported once and the worker processes are forked from the master process,
+so they share its memory and the pages of memory-mapped models
+"""
+import os
+import multiprocessing
+
+bind = os.environ.get("BIND", "0.0.0.0:5000")
+workers = int(os.environ.get("WEB_WORKERS", multiprocessing.cpu_count()))
+# requests waiting for the database or the micro-batches do not block the other requests of the worker
+worker_class = "gthread"
+threads = int(os.environ.get("WEB_THREADS", 4))
+preload_app = True
+timeout = 120
+
+
+def on_starting(server):
+    from web_server import prepare_workers
+    prepare_workers(preload_models=os.environ.get("PRELOAD_MODELS", "1") != "0")
+
+
+def post_fork(server, worker):
+    from web_server import init_worker
+    init_worker()
@@ -0,0 +1,187 @@
+import numpy as np
+
+
+def make_bins(X, max_bins=255, subsample=200000):
+    """
+    Computes quantile bin edges of each feature
+    X : numpy ndarray
+        Array of size n_objects, n_features
+    max_bins : int
+        The maximum number of bins, at most 256 so that bin fits into uint8
+    subsample : int
+        The number of objects used to compute quantiles
+    Returns
+    -------
+    edges : list
+        Sorted float32 upper edges of the bins for each feature
+    """
+    if not 2 <= max_bins <= 256:
+        raise ValueError("max_bins must be between 2 and 256")
+    X = np.asarray(X, dtype=np.float32)
+    if X.shape[0] > subsample:
+        X = X[np.random.choice(X.shape[0], size=subsample, replace=False)]
+    edges = []
+    for j in range(X.shape[1]):
+        column = X[:, j]
+        values = np.unique(column[~np.isnan(column)])
+        if values.shape[0] <= max_bins:
+            # each value gets its own bin, edges are in the middle between neighbours
+            feature_edges = ((values[:-1].astype(np.float64) + values[1:]) / 2).astype(np.float32)
+        else:
+            quantiles = np.linspace(0, 1, max_bins + 1)[1:-1]
+            feature_edges = np.quantile(column[~np.isnan(column)], quantiles).astype(np.float32)
+        edges.append(np.unique(feature_edges))
+    return edges
+
+
+def bin_features(X, edges):
+    """
+    Replaces feature values with indexes of their bins
+    Object goes to bin b if edges[b - 1] < x <= edges[b], NaN goes to the last bin
+    Returns
+    -------
+    B : numpy ndarray
+        uint8 array of size n_objects, n_features in column-major order
+    """
+    X = np.asarray(X, dtype=np.float32)
+    B = np.empty(X.shape, dtype=np.uint8, order="F")
+    for j, feature_edges in enumerate(edges):
+        B[:, j] = np.searchsorted(feature_edges, X[:, j], side="left")
+    return B
+
+
+class HistogramTree:
+    """
+    Regression tree grown on histograms of binned features
+    """
+    def __init__(self, max_depth=None, min_samples_leaf=1):
+        """
+        max_depth : int
+            The maximum depth of the tree. If None then there is no limits.
+        min_samples_leaf : int
+            The minimum weight of objects in a leaf
+        """
+        self.max_depth = max_depth
+        self.min_samples_leaf = min_samples_leaf
+        self.feature = None
+        self.bin_threshold = None
+        self.threshold = None
+        self.children_left = None
+        self.children_right = None
+        self.value = None
+        self.depth = 0
+
+    def __histograms(self, B, rows, target, weights, features, n_bins):
+        G = np.empty((len(features), n_bins))
+        H = np.empty((len(features), n_bins))
+        for j, f in enumerate(features):
+            bins = B[rows, f]
+            G[j] = np.bincount(bins, weights=target[rows], minlength=n_bins)
+            H[j] = np.bincount(bins, weights=weights[rows], minlength=n_bins)
+        return G, H
+
+    def __best_split(self, G, H):
+        g_total = G[0].sum()
+        h_total = H[0].sum()
+        GL = np.cumsum(G, axis=1)[:, :-1]
+        HL = np.cumsum(H, axis=1)[:, :-1]
+        GR = g_total - GL
+        HR = h_total - HL
+        valid = (HL >= self.min_samples_leaf) & (HR >= self.min_samples_leaf)
+        with np.errstate(divide="ignore", invalid="ignore"):
+            gain = np.where(valid, GL ** 2 / HL + GR ** 2 / HR, -np.inf) - g_total ** 2 / h_total
+        j, b = np.unravel_index(np.argmax(gain), gain.shape)
+        if not gain[j, b] > 1e-12 * max(abs(g_total ** 2 / h_total), 1e-300):
+            return None
+        return j, b
+
+    def fit(self, B, target, weights, features, edges):
+        """
+        B : numpy ndarray
+            Binned features of size n_objects, n_features
+        target : numpy ndarray
+            Array of size n_objects
+        weights : numpy ndarray
+            Multiplicity of each object in the sample, objects with zero weight are ignored
+        features : numpy ndarray
+            Indexes of the features the tree can use
+        edges : list
+            Bin edges of all features
+        """
+        n_bins = max(len(feature_edges) for feature_edges in edges) + 1
+        target = target * weights
+        weights = weights.astype(np.float64)
+        feature, bin_threshold, threshold, left, right, value = [], [], [], [], [], []
+
+        def add_node(rows, G, H, depth):
+            node = len(feature)
+            for column in (feature, bin_threshold, threshold, left, right):
+                column.append(-1)
+            value.append(G[0].sum() / H[0].sum())
+            self.depth = max(self.depth, depth)
+            split = None
+            if (self.max_depth is None or depth < self.max_depth) and rows.shape[0] > 1:
+                split = self.__best_split(G, H)
+            if split is None:
+                return node
+            j, b = split
+            f = features[j]
+            go_left = B[rows, f] <= b
+            rows_left, rows_right = rows[go_left], rows[~go_left]
+            # histogram of the smaller child is computed, the other one is a difference
+            if rows_left.shape[0] <= rows_right.shape[0]:
+                G_left, H_left = self.__histograms(B, rows_left, target, weights, features, n_bins)
+                G_right, H_right = G - G_left, H - H_left
+            else:
+                G_right, H_right = self.__histograms(B, rows_right, target, weights, features, n_bins)
+                G_left, H_left = G - G_right, H - H_right
+            feature[node] = f
+            bin_threshold[node] = b
+            threshold[node] = edges[f][b] if b < len(edges[f]) else np.inf
+            left[node] = add_node(rows_left, G_left, H_left, depth + 1)
+            right[node] = add_node(rows_right, G_right, H_right, depth + 1)
+            return node
+
+        rows = np.flatnonzero(weights > 0)
+        G, H = self.__histograms(B, rows, target, weights, features, n_bins)
+        self.depth = 0
+        add_node(rows, G, H, 0)
+        self.feature = np.array(feature, dtype=np.intp)
+        self.bin_threshold = np.array(bin_threshold, dtype=np.intp)
+        self.threshold = np.array(threshold, dtype=np.float64)
+        self.children_left = np.array(left, dtype=np.intp)
+        self.children_right = np.array(right, dtype=np.intp)
+        self.value = np.array(value, dtype=np.float64)
+        return self
+
+    def arrays(self):
+        """
+        Returns tree arrays in the format of PackedEnsemble.from_trees
+        """
+        return self.feature, self.threshold, self.children_left, self.children_right, self.value, self.depth
+
+    def apply_binned(self, B):
+        """
+        Returns index of the leaf each object with already binned features falls into
+        B : numpy ndarray
+            Binned features of size n_objects, n_features
+        """
+        is_leaf = self.children_left == -1
+        nodes_ = np.arange(self.feature.shape[0])
+        feature = np.where(is_leaf, 0, self.feature)
+        left = np.where(is_leaf, nodes_, self.children_left)
+        right = np.where(is_leaf, nodes_, self.children_right)
+        rows = np.arange(B.shape[0])
+        nodes = np.zeros(B.shape[0], dtype=np.intp)
+        for _ in range(self.depth):
+            go_left = B[rows, feature[nodes]] <= self.bin_threshold[nodes]
+            nodes = np.where(go_left, left[nodes], right[nodes])
+        return nodes
+
+    def predict_binned(self, B):
+        """
+        Predicts objects with already binned features
+        B : numpy ndarray
+            Binned features of size n_objects, n_features
+        """
+        return self.value[self.apply_binned(B)]
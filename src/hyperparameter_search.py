@@ -0,0 +1,246 @@
+import os
+import time
+import shutil
+import tempfile
+import itertools
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor, FIRST_COMPLETED, wait
+import numpy as np
+from ensembles import RandomForestMSE, GradientBoostingMSE, rmse
+from model_format import save_model, load_model
+
+
+# hyperparameters which can be searched for each model type
+SEARCH_PARAMS = {
+    "rf": ("n_estimators", "max_depth", "feature_subsample_size"),
+    "bt": ("n_estimators", "learning_rate", "max_depth", "feature_subsample_size")
+}
+_MODEL_TYPES = {"rf": RandomForestMSE, "bt": GradientBoostingMSE}
+
+_worker_data = {}
+
+
+def _init_worker(data_directory):
+    """
+    Memory-maps the data saved by the search, so all workers read the same pages
+    """
+    for name in ("X_train", "y_train", "X_val", "y_val"):
+        _worker_data[name] = np.load(os.path.join(data_directory, name + ".npy"), mmap_mode="r")
+
+
+def candidate_params(space, method="grid", n_candidates=10, random_state=None):
+    """
+    Generates parameters of the candidates
+    space : dict
+        Name of the parameter and either list of its values or {"low": a, "high": b} for random search,
+        the range is sampled uniformly, integers if both ends are integers
+    method : str
+        grid tries all combinations of the lists, random samples n_candidates combinations
+    Returns
+    -------
+    candidates : list
+        Dicts of parameters
+    """
+    names = list(space)
+    if method == "grid":
+        if any(not isinstance(space[name], list) for name in names):
+            raise ValueError("Grid search needs lists of values")
+        return [dict(zip(names, values)) for values in itertools.product(*(space[name] for name in names))]
+    if method != "random":
+        raise ValueError(f"Unknown search method {method}")
+    rng = np.random.RandomState(random_state)
+    candidates = []
+    for _ in range(n_candidates):
+        params = {}
+        for name in names:
+            values = space[name]
+            if isinstance(values, list):
+                params[name] = values[rng.randint(len(values))]
+            elif isinstance(values["low"], int) and isinstance(values["high"], int):
+                params[name] = int(rng.randint(values["low"], values["high"] + 1))
+            else:
+                params[name] = float(rng.uniform(values["low"], values["high"]))
+        candidates.append(params)
+    return candidates
+
+
+def _pruning_rungs(n_estimators, min_iterations):
+    """
+    Iterations at which the candidates compare their validation loss: min_iterations, twice as many and so on
+    """
+    rungs = []
+    iteration = min_iterations
+    while iteration < n_estimators:
+        rungs.append(iteration)
+        iteration *= 2
+    return rungs
+
+
+def _fit_candidate(index, model_type, params, directory, cancel_path, prune):
+    """
+    Fits one candidate in a worker process
+    Validation loss at the rungs is written to files of the directory, the candidate stops
+    if its loss is worse than prune["quantile"] of the losses the other candidates had at the same rung
+    Returns
+    -------
+    result : dict
+        state (done, pruned, cancelled or error), val_loss, n_trees and time. The fitted model is saved to
+        <index>.json in the directory. If the candidate fails, the message is given in the error field
+    """
+    start = time.time()
+    try:
+        return _fit_candidate_model(index, model_type, params, directory, cancel_path, prune, start)
+    except Exception as error:
+        return _failed_result(index, params, error, time.time() - start)
+
+
+def _failed_result(index, params, error, seconds):
+    """
+    Result of the candidate which raised an exception, so the other candidates of the search go on
+    """
+    return {"index": index, "params": params, "state": "error", "val_loss": None, "n_trees": 0,
+            "time": seconds, "error": f"{type(error).__name__}: {error}"}
+
+
+def _fit_candidate_model(index, model_type, params, directory, cancel_path, prune, start):
+    """
+    Fits the candidate, see _fit_candidate
+    """
+    data = _worker_data
+    model = _MODEL_TYPES[model_type](**params)
+    rungs = set(_pruning_rungs(params["n_estimators"], prune["min_iterations"])) if prune else set()
+    state = "done"
+    last_loss = None
+
+    def callback(hist):
+        nonlocal state, last_loss
+        if os.path.exists(cancel_path):
+            state = "cancelled"
+            return True
+        iteration = len(hist["time"])
+        if hist["val-loss"][-1] is not None:
+            last_loss = float(hist["val-loss"][-1])
+        if iteration not in rungs or last_loss is None:
+            return False
+        rung_directory = os.path.join(directory, f"rung-{iteration}")
+        os.makedirs(rung_directory, exist_ok=True)
+        others = []
+        for filename in os.listdir(rung_directory):
+            if filename.isdigit() and filename != str(index):
+                with open(os.path.join(rung_directory, filename)) as f:
+                    others.append(float(f.read()))
+        # the file is renamed when complete, so the other candidates never read a partial value
+        path = os.path.join(rung_directory, str(index))
+        with open(path + ".tmp", "w") as f:
+            f.write(repr(last_loss))
+        os.replace(path + ".tmp", path)
+        if len(others) >= prune["min_candidates"] and last_loss > np.quantile(others, prune["quantile"]):
+            state = "pruned"
+            return True
+        return False
+
+    hist = model.fit(data["X_train"], data["y_train"], data["X_val"], data["y_val"], callback=callback)
+    result = {
+        "index": index,
+        "params": params,
+        "state": state,
+        "val_loss": last_loss,
+        "n_trees": model.n_trees,
+        "time": time.time() - start
+    }
+    if state == "done":
+        result["val_loss"] = float(rmse(data["y_val"], model.predict(data["X_val"])))
+        save_model(model, hist, os.path.join(directory, f"{index}.json"))
+    return result
+
+
+def leaderboard(results):
+    """
+    Sorts results of the candidates: fitted ones by validation loss, then pruned, cancelled and failed ones
+    """
+    order = {"done": 0, "pruned": 1, "cancelled": 2, "error": 3}
+    ranked = sorted(results, key=lambda result: (order[result["state"]],
+                                                 np.inf if result["val_loss"] is None else result["val_loss"]))
+    return [dict(result, rank=rank) for rank, result in enumerate(ranked, 1)]
+
+
+def search(model_type, candidates, X_train, y_train, X_val=None, y_val=None, n_jobs=None, prune=True,
+           min_iterations=10, prune_quantile=0.75, min_candidates=3, val_fraction=0.2, cancel_path=None,
+           callback=None):
+    """
+    Fits the candidates in parallel worker processes and returns the best one
+    model_type : str
+        rf or bt
+    candidates : list
+        Dicts of parameters of the model constructor, see candidate_params
+    X_val, y_val : numpy ndarray
+        Validation sample. If not given, val_fraction of the train objects is held out
+    n_jobs : int
+        The number of worker processes, by default the number of processors
+    prune : bool
+        If True, a candidate stops at iterations min_iterations, 2 * min_iterations, ... when its validation loss
+        is worse than prune_quantile of the losses the other candidates had at the same iteration.
+        At least min_candidates losses are needed to prune
+    cancel_path : str
+        The search stops when this file appears
+    callback : callable
+        Called as callback(leaderboard) after each finished candidate
+    Returns
+    -------
+    model : RandomForestMSE or GradientBoostingMSE or None if no candidate finished
+    hist : dict
+        Fitting history of the best model
+    leaderboard : list
+        Results of all candidates, see leaderboard. A candidate which raises an exception gets state error,
+        the search goes on with the other ones
+    """
+    if model_type not in _MODEL_TYPES:
+        raise ValueError(f"Unknown model type {model_type}")
+    if X_val is None:
+        order = np.random.permutation(X_train.shape[0])
+        n_val = max(1, int(X_train.shape[0] * val_fraction))
+        X_train, y_train, X_val, y_val = (X_train[order[n_val:]], y_train[order[n_val:]],
+                                          X_train[order[:n_val]], y_train[order[:n_val]])
+    prune_params = {"min_iterations": min_iterations, "quantile": prune_quantile,
+                    "min_candidates": min_candidates} if prune else None
+    n_workers = max(1, min(n_jobs or os.cpu_count() or 1, len(candidates)))
+    directory = tempfile.mkdtemp(prefix="search-")
+    try:
+        # the data is written once and memory-mapped by the workers instead of being sent to each task
+        for name, array in (("X_train", X_train), ("y_train", y_train), ("X_val", X_val), ("y_val", y_val)):
+            np.save(os.path.join(directory, name + ".npy"), np.asarray(array))
+        cancel_path = cancel_path or os.path.join(directory, "cancel")
+        results = []
+        with ProcessPoolExecutor(max_workers=n_workers, mp_context=multiprocessing.get_context("spawn"),
+                                 initializer=_init_worker, initargs=(directory,)) as executor:
+            # grid lists similar candidates together, in random order the first rungs see various candidates
+            indexes = {executor.submit(_fit_candidate, index, model_type, candidates[index], directory, cancel_path,
+                                       prune_params): index
+                       for index in map(int, np.random.permutation(len(candidates)))}
+            pending = set(indexes)
+            while pending:
+                done, pending = wait(pending, return_when=FIRST_COMPLETED)
+                for future in done:
+                    try:
+                        results.append(future.result())
+                    except Exception as error:
+                        # the worker process itself failed, e.g. it was killed
+                        index = indexes[future]
+                        results.append(_failed_result(index, candidates[index], error, 0.0))
+                if callback is not None:
+                    callback(leaderboard(results))
+                if os.path.exists(cancel_path):
+                    for future in pending:
+                        future.cancel()
+                    results.extend({"index": index, "params": params, "state": "cancelled", "val_loss": None,
+                                    "n_trees": 0, "time": 0.0}
+                                   for index, params in enumerate(candidates)
+                                   if index not in {result["index"] for result in results})
+                    break
+        board = leaderboard(results)
+        if not board or board[0]["state"] != "done":
+            return None, None, board
+        best = load_model(os.path.join(directory, f"{board[0]['index']}.json"), mmap_mode=None)
+        return best["model"], best["hist"], board
+    finally:
+        shutil.rmtree(directory, ignore_errors=True)
@@ -0,0 +1,274 @@
+import os
+import json
+import time
+import uuid
+import bisect
+import threading
+from contextlib import contextmanager
+
+
+_DEFAULT_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0)
+
+
+def _format_labels(labelnames, labels, extra=()):
+    pairs = list(zip(labelnames, labels)) + list(extra)
+    if not pairs:
+        return ""
+    escaped = (str(value).replace("\\", "\\\\").replace("\"", "\\\"").replace("\n", "\\n") for _, value in pairs)
+    return "{" + ",".join(f'{name}="{value}"' for (name, _), value in zip(pairs, escaped)) + "}"
+
+
+class Counter:
+    """
+    Monotonically increasing value for each combination of labels
+    """
+    def __init__(self, name, documentation, labelnames=()):
+        """
+        name : str
+            Name of the metric
+        documentation : str
+            Description shown in HELP line
+        labelnames : tuple
+            Names of the labels, values of all of them are given on each update
+        """
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self.__values = {}
+        self.__lock = threading.Lock()
+
+    def inc(self, amount=1, **labels):
+        """
+        Increases the value with given labels by amount
+        """
+        key = tuple(labels[name] for name in self.labelnames)
+        with self.__lock:
+            self.__values[key] = self.__values.get(key, 0) + amount
+
+    def snapshot(self):
+        """
+        Returns current values as json-serializable list of pairs (labels, value)
+        """
+        with self.__lock:
+            return [[list(key), value] for key, value in self.__values.items()]
+
+    def render(self, snapshots=()):
+        """
+        Returns lines of Prometheus text format
+        snapshots : iterable
+            Snapshots of the same metric from other processes which are added to the values
+        """
+        values = {}
+        for samples in [self.snapshot(), *snapshots]:
+            for key, value in samples:
+                values[tuple(key)] = values.get(tuple(key), 0) + value
+        lines = [f"# HELP {self.name} {self.documentation}", f"# TYPE {self.name} counter"]
+        for key, value in sorted(values.items()):
+            lines.append(f"{self.name}{_format_labels(self.labelnames, key)} {value}")
+        return lines
+
+
+class Histogram:
+    """
+    Distribution of observed values in cumulative buckets for each combination of labels
+    """
+    def __init__(self, name, documentation, labelnames=(), buckets=_DEFAULT_BUCKETS):
+        """
+        buckets : tuple
+            Upper bounds of the buckets, +Inf bucket is added automatically
+        """
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self.buckets = tuple(sorted(buckets))
+        self.__values = {}
+        self.__lock = threading.Lock()
+
+    def observe(self, value, **labels):
+        """
+        Adds the value to the distribution with given labels
+        """
+        key = tuple(labels[name] for name in self.labelnames)
+        index = bisect.bisect_left(self.buckets, value)
+        with self.__lock:
+            counts = self.__values.get(key)
+            if counts is None:
+                # counts of the buckets, the last one is +Inf, and the sum of the values
+                counts = self.__values[key] = [[0] * (len(self.buckets) + 1), 0.0]
+            counts[0][index] += 1
+            counts[1] += value
+
+    def snapshot(self):
+        """
+        Returns current values as json-serializable list of triples (labels, bucket counts, sum)
+        """
+        with self.__lock:
+            return [[list(key), list(counts), total] for key, (counts, total) in self.__values.items()]
+
+    def render(self, snapshots=()):
+        """
+        Returns lines of Prometheus text format
+        snapshots : iterable
+            Snapshots of the same metric from other processes which are added to the values
+        """
+        values = {}
+        for samples in [self.snapshot(), *snapshots]:
+            for key, counts, total in samples:
+                merged = values.setdefault(tuple(key), [[0] * (len(self.buckets) + 1), 0.0])
+                merged[0] = [a + b for a, b in zip(merged[0], counts)]
+                merged[1] += total
+        lines = [f"# HELP {self.name} {self.documentation}", f"# TYPE {self.name} histogram"]
+        for key, (counts, total) in sorted(values.items()):
+            cumulative = 0
+            for bound, count in zip(self.buckets + (float("inf"),), counts):
+                cumulative += count
+                le = "+Inf" if bound == float("inf") else repr(bound)
+                lines.append(f"{self.name}_bucket{_format_labels(self.labelnames, key, [('le', le)])} {cumulative}")
+            lines.append(f"{self.name}_sum{_format_labels(self.labelnames, key)} {total}")
+            lines.append(f"{self.name}_count{_format_labels(self.labelnames, key)} {cumulative}")
+        return lines
+
+
+class Registry:
+    """
+    Collection of metrics exposed together
+    When several worker processes serve requests, each of them saves its values to a shared directory,
+    so any worker renders the totals of all processes
+    """
+    def __init__(self):
+        self.__metrics = []
+        self.__path = None
+        self.__last_save = 0.0
+        self.__lock = threading.Lock()
+
+    def counter(self, name, documentation, labelnames=()):
+        """
+        Creates and registers counter
+        """
+        metric = Counter(name, documentation, labelnames)
+        self.__metrics.append(metric)
+        return metric
+
+    def histogram(self, name, documentation, labelnames=(), buckets=_DEFAULT_BUCKETS):
+        """
+        Creates and registers histogram
+        """
+        metric = Histogram(name, documentation, labelnames, buckets)
+        self.__metrics.append(metric)
+        return metric
+
+    def share(self, directory):
+        """
+        Starts saving values of this process to directory, must be called in each worker process
+        """
+        os.makedirs(directory, exist_ok=True)
+        self.__path = os.path.join(directory, uuid.uuid4().hex + ".json")
+
+    def save(self, min_interval=1.0):
+        """
+        Saves values of this process to the shared directory if they were not saved for min_interval seconds
+        """
+        with self.__lock:
+            if self.__path is None or time.time() - self.__last_save < min_interval:
+                return
+            self.__last_save = time.time()
+            snapshot = {metric.name: metric.snapshot() for metric in self.__metrics}
+            with open(self.__path + ".tmp", "w") as f:
+                json.dump(snapshot, f)
+            os.replace(self.__path + ".tmp", self.__path)
+
+    def __other_snapshots(self):
+        if self.__path is None:
+            return []
+        directory = os.path.dirname(self.__path)
+        snapshots = []
+        for filename in os.listdir(directory):
+            path = os.path.join(directory, filename)
+            # files of finished workers are kept, so counters of the server never decrease
+            if path == self.__path or not filename.endswith(".json"):
+                continue
+            try:
+                with open(path) as f:
+                    snapshots.append(json.load(f))
+            except (OSError, ValueError):
+                continue
+        return snapshots
+
+    def render(self):
+        """
+        Returns all metrics in Prometheus text exposition format
+        """
+        snapshots = self.__other_snapshots()
+        lines = []
+        for metric in self.__metrics:
+            lines.extend(metric.render([snapshot.get(metric.name, []) for snapshot in snapshots]))
+        return "\n".join(lines) + "\n"
+
+
+registry = Registry()
+STAGE_SECONDS = registry.histogram("stage_duration_seconds",
+                                   "Duration of the stages of request processing and model fitting", ["stage"])
+_local = threading.local()
+
+
+def record_stage(name, seconds):
+    """
+    Adds duration of the stage to the histogram and to the stages collected by the current thread
+    """
+    STAGE_SECONDS.observe(seconds, stage=name)
+    events = getattr(_local, "events", None)
+    if events is not None:
+        events.append((name, seconds))
+
+
+def observe_stages(events):
+    """
+    Adds stages collected in another process to the histogram
+    events : list
+        Pairs (stage, seconds)
+    """
+    for name, seconds in events:
+        STAGE_SECONDS.observe(seconds, stage=name)
+
+
+@contextmanager
+def stage(name):
+    """
+    Measures wall time of the code inside with block as the stage
+    """
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        record_stage(name, time.perf_counter() - start)
+
+
+def start_collecting():
+    """
+    Starts collecting stages recorded by the current thread
+    Returns
+    -------
+    events : list
+        Pairs (stage, seconds) appended as the stages finish
+    """
+    _local.events = []
+    return _local.events
+
+
+def stop_collecting():
+    """
+    Stops collecting stages of the current thread and returns them
+    """
+    events = getattr(_local, "events", None)
+    _local.events = None
+    return events or []
+
+
+def summarize(events):
+    """
+    Total duration of each stage, in order of the first occurrence
+    """
+    totals = {}
+    for name, seconds in events:
+        totals[name] = totals.get(name, 0.0) + seconds
+    return totals
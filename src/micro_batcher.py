@@ -0,0 +1,88 @@
+import threading
+from concurrent.futures import Future
+import numpy as np
+
+
+class _Batch:
+    """
+    Requests collected for one predict call
+    """
+    def __init__(self):
+        self.items = []
+        self.n_rows = 0
+        self.full = threading.Event()
+
+
+class MicroBatcher:
+    """
+    Coalesces concurrent small predictions for the same model into one predict call
+    The first request of a batch waits for the others at most max_wait_ms or until the batch is full,
+    then it makes predictions for the whole batch and the other requests get their parts.
+    The first request does not wait if no batch of the model is being predicted, so single requests
+    are not delayed when the server is idle
+    """
+    def __init__(self, max_batch_size=256, max_wait_ms=2.0):
+        """
+        max_batch_size : int
+            The number of rows after which the batch is predicted without waiting
+        max_wait_ms : float
+            The maximum time the first request of a batch waits for the others
+        """
+        self.max_batch_size = max_batch_size
+        self.max_wait_ms = max_wait_ms
+        self.__batches = {}
+        self.__running = {}
+        self.__lock = threading.Lock()
+
+    def predict(self, key, X, predict):
+        """
+        Returns predictions for X made together with the other requests with the same key
+        key : hashable
+            Requests with equal keys are batched, e.g. name of the model and the number of features
+        X : numpy ndarray
+            Array of size n_objects, n_features
+        predict : callable
+            Makes predictions for the concatenated batch, the one of the first request is used
+        """
+        future = Future()
+        with self.__lock:
+            batch = self.__batches.get(key)
+            is_first = batch is None
+            if is_first:
+                batch = self.__batches[key] = _Batch()
+            batch.items.append((X, future))
+            batch.n_rows += X.shape[0]
+            if batch.n_rows >= self.max_batch_size:
+                # next requests start a new batch
+                del self.__batches[key]
+                batch.full.set()
+            is_busy = self.__running.get(key, 0) > 0
+        if is_first:
+            if is_busy:
+                batch.full.wait(self.max_wait_ms / 1000)
+            with self.__lock:
+                if self.__batches.get(key) is batch:
+                    del self.__batches[key]
+                self.__running[key] = self.__running.get(key, 0) + 1
+            try:
+                self.__run(batch, predict)
+            finally:
+                with self.__lock:
+                    self.__running[key] -= 1
+                    if not self.__running[key]:
+                        del self.__running[key]
+        return future.result()
+
+    def __run(self, batch, predict):
+        try:
+            if len(batch.items) == 1:
+                preds = [predict(batch.items[0][0])]
+            else:
+                sizes = np.cumsum([X.shape[0] for X, _ in batch.items])[:-1]
+                preds = np.split(predict(np.concatenate([X for X, _ in batch.items])), sizes)
+        except Exception as error:
+            for _, future in batch.items:
+                future.set_exception(error)
+            return
+        for (_, future), part in zip(batch.items, preds):
+            future.set_result(part)
@@ -0,0 +1,6 @@
+from web_server import db, app, Model
+
+with app.app_context():
+    migrated = [model.name for model in Model.query.all() if model.migrate()]
+    db.session.commit()
+    print(f"Migrated {len(migrated)} models to native format: {', '.join(migrated)}")
@@ -0,0 +1,104 @@
+import os
+import threading
+from collections import OrderedDict
+from model_format import load_model, model_files
+
+
+class ModelCache:
+    """
+    LRU cache of loaded models bounded by the number of entries and their total size
+    """
+    def __init__(self, max_entries=16, max_bytes=512 * 1024 ** 2):
+        """
+        max_entries : int
+            The maximum number of models kept in memory
+        max_bytes : int
+            The maximum total size of cached model files on disk, trees are memory-mapped,
+            so this bounds the pages the cached models can keep in memory
+        """
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.__entries = OrderedDict()
+        self.__bytes = 0
+        self.__directory_mtime = None
+        self.__lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def get(self, name, path):
+        """
+        Returns the model and its fitting history, loading them only if the model file changed
+        name : str
+            Name of the model
+        path : str
+            Path to the metadata file of the model
+        """
+        stat = os.stat(path)
+        key = (name, stat.st_mtime_ns, stat.st_size)
+        with self.__lock:
+            entry = self.__entries.get(name)
+            if entry is not None and entry[0] == key:
+                self.__entries.move_to_end(name)
+                self.hits += 1
+                return entry[1]
+            self.misses += 1
+        data = load_model(path)
+        size = sum(os.path.getsize(model_path) for model_path in model_files(path))
+        with self.__lock:
+            self.__remove(name)
+            if size <= self.max_bytes and self.max_entries > 0:
+                self.__entries[name] = (key, data, size, path)
+                self.__bytes += size
+                while len(self.__entries) > self.max_entries or self.__bytes > self.max_bytes:
+                    self.__remove(next(iter(self.__entries)))
+                    self.evictions += 1
+        return data
+
+    def invalidate(self, name):
+        """
+        Drops the model from cache, e.g. after it was refitted or deleted
+        """
+        with self.__lock:
+            self.__remove(name)
+
+    def refresh(self, directory):
+        """
+        Drops models whose files were changed or deleted, e.g. by another worker process.
+        Files are checked only if the directory changed since the previous call, so it is cheap to call on each request
+        directory : str
+            Directory with the model files
+        """
+        mtime = os.stat(directory).st_mtime_ns
+        with self.__lock:
+            if mtime == self.__directory_mtime:
+                return
+            self.__directory_mtime = mtime
+            for name, (key, _, _, path) in list(self.__entries.items()):
+                try:
+                    stat = os.stat(path)
+                except FileNotFoundError:
+                    self.__remove(name)
+                    continue
+                if key != (name, stat.st_mtime_ns, stat.st_size):
+                    self.__remove(name)
+
+    def __remove(self, name):
+        entry = self.__entries.pop(name, None)
+        if entry is not None:
+            self.__bytes -= entry[2]
+
+    def stats(self):
+        """
+        Returns counters which help to choose size of the cache
+        """
+        with self.__lock:
+            return {
+                "entries": len(self.__entries),
+                "bytes": self.__bytes,
+                "max_entries": self.max_entries,
+                "max_bytes": self.max_bytes,
+                "hits": self.hits,
+                "misses": self.misses,
+                "evictions": self.evictions
+            }
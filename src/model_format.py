@@ -0,0 +1,160 @@
+import os
+import json
+import uuid
+import pickle
+import numpy as np
+from ensembles import RandomForestMSE, GradientBoostingMSE
+from tree_engine import PackedEnsemble
+
+
+# version of the native format, files of newer versions are not read
+FORMAT_VERSION = 1
+_MODEL_CLASSES = {cls.__name__: cls for cls in (RandomForestMSE, GradientBoostingMSE)}
+
+
+def _json_default(value):
+    """
+    Converts numpy values which json does not know
+    """
+    if isinstance(value, (np.generic, np.ndarray)):
+        return value.tolist()
+    raise TypeError(f"Object of type {type(value).__name__} is not JSON serializable")
+
+
+def write_json(path, data):
+    """
+    Atomically replaces json file, so readers never see it half-written
+    """
+    tmp_path = path + ".tmp"
+    with open(tmp_path, "w") as f:
+        json.dump(data, f, default=_json_default)
+    os.replace(tmp_path, path)
+
+
+def load_metadata(path):
+    """
+    Reads params and fitting history of the model without touching its trees
+    path : str
+        Path to the metadata file of the model
+    Returns
+    -------
+    meta : dict
+        format_version, model_class, params, hist and trees: name of the trees file, the number of trees
+        and their depth or None if the model is not fitted
+    """
+    with open(path) as f:
+        meta = json.load(f)
+    if meta.get("format_version", 0) > FORMAT_VERSION:
+        raise ValueError(f"Unsupported model format version {meta.get('format_version')}")
+    return meta
+
+
+def _trees_filename(path):
+    """
+    Returns new unique name of the trees file for the model with metadata file at path,
+    the old trees file stays valid for the readers which still use it
+    """
+    return f"{os.path.splitext(os.path.basename(path))[0]}.{uuid.uuid4().hex[:8]}.npy"
+
+
+def model_files(path):
+    """
+    Returns paths of the metadata file and the trees file of the model
+    """
+    # models pickled by the previous versions are kept in one file
+    if path.endswith(".pickle"):
+        return [path]
+    meta = load_metadata(path)
+    if meta["trees"] is None:
+        return [path]
+    return [path, os.path.join(os.path.dirname(path), meta["trees"]["file"])]
+
+
+def save_model(model, hist, path, leaderboard=None):
+    """
+    Saves the model in native format: params and hist into json metadata file at path,
+    nodes of all trees into one .npy file next to it, which can be memory-mapped
+    The metadata file is replaced last, so readers see either the old or the new model
+    model : RandomForestMSE or GradientBoostingMSE
+    hist : dict
+        Fitting history or None if the model is not fitted
+    leaderboard : list
+        Results of the hyperparameter search which found the model, if any
+    """
+    meta = {
+        "format_version": FORMAT_VERSION,
+        "model_class": type(model).__name__,
+        "params": model.get_params(deep=True),
+        "hist": hist,
+        "trees": None
+    }
+    if leaderboard is not None:
+        meta["leaderboard"] = leaderboard
+    if model.engine is not None:
+        trees_file = _trees_filename(path)
+        np.save(os.path.join(os.path.dirname(path), trees_file), model.engine.to_table())
+        meta["trees"] = {
+            "file": trees_file,
+            "n_trees": model.engine.n_trees,
+            "depth": int(model.engine.depth)
+        }
+    old_files = model_files(path)[1:] if os.path.exists(path) else []
+    write_json(path, meta)
+    for old_path in old_files:
+        os.remove(old_path)
+
+
+def load_model(path, mmap_mode="r"):
+    """
+    Reads the model saved by save_model
+    path : str
+        Path to the metadata file of the model
+    mmap_mode : str
+        Mode of np.load for the trees file. By default trees are memory-mapped read-only,
+        so loading is instant and the nodes are read from disk when prediction visits them
+    Returns
+    -------
+    data : dict
+        model, hist and leaderboard of the hyperparameter search or None
+    """
+    meta = load_metadata(path)
+    engine = None
+    if meta["trees"] is not None:
+        table = np.load(os.path.join(os.path.dirname(path), meta["trees"]["file"]), mmap_mode=mmap_mode)
+        engine = PackedEnsemble.from_table(table, meta["trees"]["depth"])
+    model = _MODEL_CLASSES[meta["model_class"]].from_packed(meta["params"], engine)
+    return {"model": model, "hist": meta["hist"], "leaderboard": meta.get("leaderboard")}
+
+
+def move_model(src_path, dst_path):
+    """
+    Moves the model saved at src_path to dst_path, replacing the model saved there
+    """
+    meta = load_metadata(src_path)
+    old_files = model_files(dst_path)[1:] if os.path.exists(dst_path) else []
+    if meta["trees"] is not None:
+        trees_path = os.path.join(os.path.dirname(src_path), meta["trees"]["file"])
+        meta["trees"]["file"] = _trees_filename(dst_path)
+        os.replace(trees_path, os.path.join(os.path.dirname(dst_path), meta["trees"]["file"]))
+    write_json(dst_path, meta)
+    os.remove(src_path)
+    for old_path in old_files:
+        os.remove(old_path)
+
+
+def remove_model(path):
+    """
+    Removes all files of the model
+    """
+    for model_path in model_files(path):
+        os.remove(model_path)
+
+
+def migrate_pickle(pickle_path, path):
+    """
+    Converts the model pickled as {"model", "hist"} into native format and removes the pickle
+    """
+    with open(pickle_path, "rb") as f:
+        data = pickle.load(f)
+    save_model(data["model"], data["hist"], path)
+    os.remove(pickle_path)
@@ -1,4 +1,6 @@
-from web_server import app
+from web_server import app, prepare_workers
 
 if __name__ == '__main__':
+    # the same preparation as gunicorn does before starting the workers, e.g. jobs of the previous run are failed
+    prepare_workers()
     app.run(host='0.0.0.0', port=5000, debug=False)
@@ -25,9 +25,28 @@ add_model_show.onclick = function () {
             <label for="model_features" style="margin-top: 1rem" class="form-label">Размер признакового пространства для каждого дерева</label>
             <input type="number" class="form-control" id="model_features" min="0" max="1" step="0.01">
             <small class="form-text text-muted">Ничего не вводите для значения равного 1/3</small>
+            <label for="model_patience" style="margin-top: 1rem" class="form-label">Ранняя остановка: число итераций без улучшения</label>
+            <input type="number" class="form-control" id="model_patience" min="1">
+            <small class="form-text text-muted">Работает только при наличии валидационной выборки. Ничего не вводите, чтобы обучать все деревья</small>
             <label for="model_lr" style="margin-top: 1rem" class="form-label">Learning rate</label>
             <input type="number" class="form-control" id="model_lr" min="0" step="0.01">
             <small class="form-text text-muted">Нужно заполнить только для градиентного бустинга. Ничего не вводите для значения 0.1</small>
+            <div class="form-check" style="margin-top: 1rem">
+                <input class="form-check-input" type="checkbox" id="model_histogram">
+                <label for="model_histogram" class="form-check-label">Гистограммный режим обучения</label>
+            </div>
+            <small class="form-text text-muted">Только для градиентного бустинга. Ускоряет обучение на больших выборках</small>
+            <div class="form-check" style="margin-top: 1rem">
+                <input class="form-check-input" type="checkbox" id="model_oob">
+                <label for="model_oob" class="form-check-label">Считать ошибку out-of-bag</label>
+            </div>
+            <small class="form-text text-muted">Только для случайного леса</small>
+            <label for="model_eval_period" style="margin-top: 1rem" class="form-label">Считать ошибку каждые k итераций</label>
+            <input type="number" class="form-control" id="model_eval_period" min="1">
+            <small class="form-text text-muted">Ничего не вводите, чтобы считать ошибку на каждой итерации</small>
+            <label for="model_eval_subsample" style="margin-top: 1rem" class="form-label">Доля обучающей выборки для подсчета ошибки</label>
+            <input type="number" class="form-control" id="model_eval_subsample" min="0" max="1" step="0.01">
+            <small class="form-text text-muted">Ничего не вводите, чтобы считать ошибку на всей обучающей выборке</small>
         </div>
      `;
      let footer = document.getElementById("modal_footer");
@@ -57,15 +76,15 @@ function show_fit_model(name) {
      form.innerHTML = `
         <div class="form-group">
             <label for="train_data" class="form-label">Файл с обучающей выборкой</label>
-            <input class="form-control" type="file" id="train_data" accept=".csv">
+            <input class="form-control" type="file" id="train_data" accept=".csv,.npy,.npz,.parquet,.arrow,.feather">
             <label for="train_data" class="form-label" style="margin-top: 1rem">Файл с валидационной выборкой</label>
-            <input class="form-control" type="file" id="val_data" accept=".csv">
+            <input class="form-control" type="file" id="val_data" accept=".csv,.npy,.npz,.parquet,.arrow,.feather">
             <small class="form-text text-muted">Опционально</small>
             <label for="train_data" class="form-label" style="margin-top: 1rem">Название колонки с целевой переменной</label>
             <input class="form-control" type="text" id="target_column">
             <label for="train_data" class="form-label" style="margin-top: 1rem">Описание данных</label>
             <textarea class="form-control" id="data_description" maxlength="300"></textarea>
-            <p style="margin-top: 1.5rem">После нажатия кнопки "Обучить" дождитесь появления сообщения об окончании обучения</p>
+            <p style="margin-top: 1.5rem">После нажатия кнопки "Обучить" можно следить за ходом обучения или отменить его</p>
         </div>
      `;
      let footer = document.getElementById("modal_footer");
@@ -76,6 +95,35 @@ function show_fit_model(name) {
      $("#modal").modal("show");
 }
 
+function show_continue_fit(name) {
+    let title = document.getElementById("modal_label");
+    title.innerText = "Дообучить модель";
+    let form = document.getElementById("modal_body");
+     form.innerHTML = `
+        <div class="form-group">
+            <label for="n_estimators" class="form-label">Количество новых деревьев</label>
+            <input type="number" class="form-control" id="n_estimators" min="1">
+            <label for="train_data" class="form-label" style="margin-top: 1rem">Файл с обучающей выборкой</label>
+            <input class="form-control" type="file" id="train_data" accept=".csv,.npy,.npz,.parquet,.arrow,.feather">
+            <label for="train_data" class="form-label" style="margin-top: 1rem">Файл с валидационной выборкой</label>
+            <input class="form-control" type="file" id="val_data" accept=".csv,.npy,.npz,.parquet,.arrow,.feather">
+            <small class="form-text text-muted">Опционально</small>
+            <label for="train_data" class="form-label" style="margin-top: 1rem">Название колонки с целевой переменной</label>
+            <input class="form-control" type="text" id="target_column">
+            <label for="train_data" class="form-label" style="margin-top: 1rem">Описание данных</label>
+            <textarea class="form-control" id="data_description" maxlength="300"></textarea>
+            <small class="form-text text-muted">Ничего не вводите, чтобы оставить прежнее описание</small>
+            <p style="margin-top: 1.5rem">Новые деревья добавляются к уже обученным, история обучения продолжается</p>
+        </div>
+     `;
+     let footer = document.getElementById("modal_footer");
+     footer.innerHTML = `
+       <button type="button" class="btn btn-warning" onclick="continue_fit('${name}')">Дообучить</button>
+       <button type="button" class="btn btn-primary" data-bs-dismiss="modal">Закрыть</button>
+    `;
+     $("#modal").modal("show");
+}
+
 function show_predict_with_model(name) {
     let title = document.getElementById("modal_label");
     title.innerText = "Получить предсказания";
@@ -83,9 +131,13 @@ function show_predict_with_model(name) {
      form.innerHTML = `
         <div class="form-group">
             <label for="test_data" class="form-label">Файл с данными для предсказания</label>
-            <input class="form-control" type="file" id="test_data" accept=".csv">
+            <input class="form-control" type="file" id="test_data" accept=".csv,.npy,.npz,.parquet,.arrow,.feather">
             <label for="column_name" class="form-label" style="margin-top: 1.5rem">Название колонки с предсказаниями</label>
             <input type="text" id="column_name" class="form-control">
+            <label for="max_trees" class="form-label" style="margin-top: 1.5rem">Максимальное число деревьев (по умолчанию все)</label>
+            <input type="number" min="1" id="max_trees" class="form-control">
+            <label for="time_budget_ms" class="form-label" style="margin-top: 1.5rem">Ограничение времени предсказания, мс (необязательно)</label>
+            <input type="number" min="1" id="time_budget_ms" class="form-control">
             <p style="margin-top: 1.5rem">После нажатия кнопки "Предсказать" будет скачан файл с предсказаниями</p>
         </div>
      `;
@@ -120,9 +172,17 @@ function get_info_about_model(name) {
                         ${params.max_depth ? params.max_depth : "не ограничена"}</p>
                     <p><strong>Размер признакового пространства для каждого дерева: </strong>
                         ${params.feature_subsample_size ? params.feature_subsample_size : "1/3"}</p>
+                    <p><strong>Ранняя остановка: </strong>
+                        ${params.early_stopping_rounds ? `после ${params.early_stopping_rounds} итераций без улучшения` : "нет"}</p>
+                    <p><strong>Подсчет ошибки: </strong>
+                        ${params.eval_period > 1 ? `каждые ${params.eval_period} итераций` : "на каждой итерации"},
+                        ${params.eval_subsample ? `на доле ${params.eval_subsample} обучающей выборки` : "на всей обучающей выборке"}</p>
                 `;
                 if (info.model_type === "bt") {
                     form.innerHTML += `<p><strong>Learning rate: </strong>${params.learning_rate}</p>`;
+                    form.innerHTML += `<p><strong>Гистограммный режим: </strong>${params.histogram ? "да" : "нет"}</p>`;
+                } else {
+                    form.innerHTML += `<p><strong>Ошибка out-of-bag: </strong>${params.oob_loss ? "да" : "нет"}</p>`;
                 }
                 form.innerHTML += `<p><strong style="color: ${info.is_fitted ? "#76b45a" : "#f5554a"}">
                                         ${info.is_fitted ? "Модель обучена": "Модель не обучена"}
@@ -134,6 +194,24 @@ function get_info_about_model(name) {
                         form.innerHTML += `<p><strong style="color: orange">Описание данных не предоставлено</strong></p>`;
                     }
                 }
+                if (info.hasOwnProperty("leaderboard")) {
+                    const states = {"done": "обучена", "pruned": "остановлена досрочно", "cancelled": "отменена",
+                                    "error": "ошибка"};
+                    let rows = info.leaderboard.map(result => `
+                        <tr>
+                            <td>${result.rank}</td>
+                            <td>${Object.entries(result.params).map(([key, value]) => `${key}=${value}`).join(", ")}</td>
+                            <td>${result.val_loss === null ? "-" : result.val_loss.toFixed(4)}</td>
+                            <td>${result.n_trees}</td>
+                            <td title="${result.error || ""}">${states[result.state]}</td>
+                        </tr>`).join("");
+                    form.innerHTML += `
+                        <p><strong>Результаты подбора гиперпараметров: </strong></p>
+                        <table class="table table-sm">
+                            <thead><tr><th>#</th><th>Параметры</th><th>RMSE на валидации</th><th>Деревьев</th><th>Статус</th></tr></thead>
+                            <tbody>${rows}</tbody>
+                        </table>`;
+                }
                 if (info.hasOwnProperty("plot")) {
                     form.innerHTML += `<div class="col-12" id="div-plot"></div>`;
                     let config={"toImageButtonOptions": {"format": "svg"}}
@@ -183,6 +261,7 @@ function create_table(data) {
             <td><button class="btn btn-primary" onclick="get_info_about_model('${data[j][0]}')">Подробнее</button></td>
             <td>
                 <button class="btn btn-warning" onclick="show_fit_model('${data[j][0]}')">Обучить</button>
+                <button class="btn btn-warning" onclick="show_continue_fit('${data[j][0]}')">Дообучить</button>
                 <button class="btn btn-success" onclick="show_predict_with_model('${data[j][0]}')">Предсказать</button>
                 <button class="btn btn-danger" onclick="delete_model('${data[j][0]}')">Удалить</button>
             </td>
@@ -207,13 +286,23 @@ function create_model() {
     let md_depth = document.getElementById("model_depth").value;
     let md_features = document.getElementById("model_features").value;
     let md_lr = document.getElementById("model_lr").value;
+    let md_histogram = document.getElementById("model_histogram").checked;
+    let md_patience = document.getElementById("model_patience").value;
+    let md_oob = document.getElementById("model_oob").checked;
+    let md_eval_period = document.getElementById("model_eval_period").value;
+    let md_eval_subsample = document.getElementById("model_eval_subsample").value;
     axios.post("/add_model", {model_type: md_type,
                                  model_name: md_name,
                                  model_descr: md_descr,
                                  model_est: md_estimators,
                                  model_depth: md_depth,
                                  model_features: md_features,
-                                 model_lr: md_lr})
+                                 model_lr: md_lr,
+                                 model_histogram: md_histogram,
+                                 model_patience: md_patience,
+                                 model_oob: md_oob,
+                                 model_eval_period: md_eval_period,
+                                 model_eval_subsample: md_eval_subsample})
         .then(response => {
            if (response.data[0] === "Error") {
                show_message("Ошибка", response.data[1]);
@@ -257,7 +346,7 @@ function fit_model(name) {
           if (response.data[0] === "Error") {
               show_message("Ошибка", response.data[1]);
           } else {
-              show_message("Успех", `Информацию об обучении теперь можно посмотреть по нажатию кнопки "Подробнее"`);
+              show_fit_status(response.data[1]);
           }
           get_all_models();
         }).catch(error => {
@@ -265,6 +354,91 @@ function fit_model(name) {
     });
 }
 
+function continue_fit(name) {
+    let data = new FormData();
+    let train = document.getElementById("train_data");
+    let val = document.getElementById("val_data");
+    let target = document.getElementById("target_column");
+    let description = document.getElementById("data_description");
+    let n_estimators = document.getElementById("n_estimators");
+    data.append("train", train.files[0]);
+    data.append("val", val.files[0]);
+    data.append("target", target.value);
+    data.append("model", name);
+    data.append("data_description", description.value);
+    data.append("n_estimators", n_estimators.value);
+    axios.post("/continue_fit", data, {
+         headers: {
+            "Content-Type": "multipart/form-data",
+         }})
+        .then(response => {
+          if (response.data[0] === "Error") {
+              show_message("Ошибка", response.data[1]);
+          } else {
+              show_fit_status(response.data[1]);
+          }
+          get_all_models();
+        }).catch(error => {
+            show_message("Ошибка", "Не удалось дообучить модель. Проверьте корректность введенных данных");
+    });
+}
+
+function show_fit_status(job_id) {
+    let title = document.getElementById("modal_label");
+    title.innerText = "Обучение модели";
+    let form = document.getElementById("modal_body");
+    form.innerHTML = `<p id="fit_progress">Обучение поставлено в очередь</p><div class="col-12" id="div-plot"></div>`;
+    let footer = document.getElementById("modal_footer");
+    footer.innerHTML = `
+      <button type="button" class="btn btn-danger" onclick="cancel_fit('${job_id}')">Отменить</button>
+      <button type="button" class="btn btn-primary" data-bs-dismiss="modal">Закрыть</button>
+    `;
+    $("#modal").modal("show");
+    poll_fit_status(job_id);
+}
+
+function poll_fit_status(job_id) {
+    axios.get(`/get_fit_status?job_id=${job_id}`)
+        .then(response => {
+            let progress = document.getElementById("fit_progress");
+            if (response.data[0] === "Error" || !progress) {
+                return;
+            }
+            let status = response.data[1];
+            if (status.state === "done") {
+                show_message("Успех", `Информацию об обучении теперь можно посмотреть по нажатию кнопки "Подробнее"`);
+                get_all_models();
+                return;
+            }
+            if (status.state === "cancelled") {
+                show_message("Обучение отменено", "Модель осталась в прежнем состоянии");
+                return;
+            }
+            if (status.state === "error") {
+                show_message("Ошибка", "Не удалось обучить модель. Проверьте корректность введенных данных");
+                return;
+            }
+            if (status.state === "running") {
+                progress.innerText = `Обучено деревьев: ${status.iteration} из ${status.n_estimators}`;
+            }
+            if (status.hasOwnProperty("plot")) {
+                Plotly.react("div-plot", JSON.parse(status.plot), {});
+            }
+            setTimeout(() => poll_fit_status(job_id), 1000);
+        }).catch(error => {
+            setTimeout(() => poll_fit_status(job_id), 1000);
+    });
+}
+
+function cancel_fit(job_id) {
+    axios.get(`/cancel_fit?job_id=${job_id}`)
+        .then(response => {
+            if (response.data[0] === "Error") {
+                show_message("Ошибка", response.data[1]);
+            }
+        });
+}
+
 function predict(name) {
     let data = new FormData();
     let test = document.getElementById("test_data");
@@ -272,19 +446,24 @@ function predict(name) {
     data.append("test", test.files[0]);
     data.append("model", name);
     data.append("column_name", column_name.value);
+    data.append("max_trees", document.getElementById("max_trees").value);
+    data.append("time_budget_ms", document.getElementById("time_budget_ms").value);
+    data.append("stream", "1");
     axios.post("/predict", data, {
          headers: {
             "Content-Type": "multipart/form-data",
-         }})
-        .then(response => {
-          if (response.data[0] === "Error") {
-              show_message("Ошибка", response.data[1]);
+         },
+         responseType: "blob"})
+        .then(async response => {
+          if (response.headers["content-type"].startsWith("application/json")) {
+              const message = JSON.parse(await response.data.text());
+              show_message("Ошибка", message[1]);
           } else {
-              console.log(response)
-              const url = window.URL.createObjectURL(new Blob([response.data]));
+              const disposition = /filename=(.+)/.exec(response.headers["content-disposition"]);
+              const url = window.URL.createObjectURL(response.data);
               const link = document.createElement("a");
               link.href = url;
-              link.setAttribute("download", `${name}_predictions.csv`);
+              link.setAttribute("download", disposition ? disposition[1] : `${name}_predictions.csv`);
               document.body.appendChild(link);
               link.click();
               document.body.removeChild(link);
@@ -0,0 +1,382 @@
+import os
+import json
+import time
+import uuid
+import hashlib
+import threading
+import multiprocessing
+from concurrent.futures import Future, ProcessPoolExecutor
+from model_format import load_model, save_model, remove_model, write_json as _write_json
+from metrics import stage, start_collecting, stop_collecting, observe_stages
+from hyperparameter_search import search
+try:
+    import fcntl
+except ImportError:
+    # without file locks the jobs are limited only within each server process
+    fcntl = None
+
+# how often a queued job checks whether a slot is free
+_SLOT_POLL_SECONDS = 0.5
+
+
+def _take_slot(prefix, n_slots):
+    """
+    Locks one of the slots shared by all server processes, so the number of jobs running at once
+    does not grow with the number of server processes
+    prefix : str
+        Path prefix of the lock files of the slots
+    Returns
+    -------
+    file : file object or None if all slots are taken
+        Closing the file releases the slot, the system releases it if the process dies
+    """
+    for index in range(n_slots):
+        f = open(f"{prefix}-{index}.lock", "a")
+        try:
+            fcntl.flock(f, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            return f
+        except BlockingIOError:
+            f.close()
+    return None
+
+
+def _copy_outcome(source, target):
+    """
+    Passes the result or the exception of the pool future to the future of the job
+    """
+    error = source.exception()
+    if error is None:
+        target.set_result(source.result())
+    else:
+        target.set_exception(error)
+
+
+def _run_fit(status_path, cancel_path, result_path, model_path, X_train, y_train, X_val, y_val, n_more=None):
+    """
+    Fits the model from model_path in a worker process and saves it to result_path
+    Progress is written to status_path after the iterations, cancel_path appearing stops fitting
+    If n_more is given, the fitted model is extended by n_more trees
+    Returns
+    -------
+    events : list or None if fitting was cancelled
+        Durations of the stages as pairs (stage, seconds), they are added to the metrics of the server process
+    """
+    if os.path.exists(cancel_path):
+        # the job was cancelled by another server process while it was in the queue
+        return None
+    events = start_collecting()
+    try:
+        return events if _fit_and_save(status_path, cancel_path, model_path, result_path,
+                                       X_train, y_train, X_val, y_val, n_more) else None
+    finally:
+        stop_collecting()
+
+
+def _fit_and_save(status_path, cancel_path, model_path, result_path, X_train, y_train, X_val, y_val, n_more):
+    """
+    Body of _run_fit
+    Returns
+    -------
+    True if the model was fitted, False if fitting was cancelled
+    """
+    with stage("load"):
+        data = load_model(model_path)
+    if n_more is None:
+        n_estimators = data["model"].get_params(deep=False)["n_estimators"]
+    else:
+        n_estimators = data["model"].n_trees + n_more
+    status = {
+        "state": "running",
+        "n_estimators": n_estimators,
+        "iteration": 0,
+        "hist": None
+    }
+    _write_json(status_path, status)
+    last_write = time.time()
+
+    def callback(hist):
+        nonlocal last_write
+        if os.path.exists(cancel_path):
+            return True
+        if time.time() - last_write > 0.5:
+            status["iteration"] = len(hist["time"])
+            status["hist"] = hist
+            _write_json(status_path, status)
+            last_write = time.time()
+        return False
+
+    if n_more is None:
+        hist = data["model"].fit(X_train, y_train, X_val, y_val, callback=callback)
+    else:
+        hist = data["model"].continue_fit(X_train, y_train, n_more, X_val, y_val,
+                                          hist=data["hist"], callback=callback)
+    if os.path.exists(cancel_path):
+        return False
+    status["iteration"] = len(hist["time"])
+    status["hist"] = hist
+    _write_json(status_path, status)
+    # fitting from scratch replaces the model found by the search, so its leaderboard is kept only by continue_fit
+    leaderboard = data["leaderboard"] if n_more is not None else None
+    with stage("persist"):
+        save_model(data["model"], hist, result_path, leaderboard=leaderboard)
+    return True
+
+
+def _run_search(status_path, cancel_path, result_path, model_type, candidates, X_train, y_train, X_val, y_val,
+                search_params):
+    """
+    Runs hyperparameter search in a worker process and saves the best model with the leaderboard to result_path
+    Leaderboard is written to status_path after each finished candidate
+    Returns
+    -------
+    events : list or None if the search was cancelled
+    """
+    if os.path.exists(cancel_path):
+        return None
+    status = {
+        "state": "running",
+        "n_estimators": len(candidates),
+        "iteration": 0,
+        "hist": None,
+        "leaderboard": []
+    }
+    _write_json(status_path, status)
+
+    def callback(board):
+        status["iteration"] = len(board)
+        status["leaderboard"] = board
+        _write_json(status_path, status)
+
+    events = start_collecting()
+    try:
+        with stage("search"):
+            model, hist, board = search(model_type, candidates, X_train, y_train, X_val, y_val,
+                                        cancel_path=cancel_path, callback=callback, **search_params)
+        if os.path.exists(cancel_path):
+            return None
+        if model is None:
+            raise RuntimeError("No candidate was fitted")
+        with stage("persist"):
+            save_model(model, hist, result_path, leaderboard=board)
+        return events
+    finally:
+        stop_collecting()
+
+
+class TrainingJobs:
+    """
+    Queue of model fittings executed by a pool of worker processes
+    Status of the jobs is kept in files, so several server processes sharing jobs_directory
+    can report and cancel the jobs of each other. The limits are shared by the processes too:
+    a thread of the server process waits until one of the lock files of jobs_directory is free
+    and only then passes the job to the pool of its kind
+    """
+    def __init__(self, jobs_directory, max_workers=2, max_searches=1):
+        """
+        jobs_directory : str
+            Directory for status files of the jobs
+        max_workers : int
+            The number of models fitted simultaneously by all server processes
+        max_searches : int
+            The number of hyperparameter searches run simultaneously by all server processes,
+            each of them fits the candidates in its own pool of processes
+        """
+        self.jobs_directory = jobs_directory
+        self.max_workers = max_workers
+        self.max_searches = max_searches
+        self.__executors = {}
+        self.__jobs = {}
+        self.__lock = threading.Lock()
+
+    def __paths(self, job_id):
+        path = os.path.join(self.jobs_directory, job_id)
+        return path + ".json", path + ".cancel", path + ".model.json"
+
+    def __active_path(self, name):
+        # locked while the model is being fitted by any of the server processes
+        return os.path.join(self.jobs_directory, hashlib.sha1(name.encode()).hexdigest() + ".active")
+
+    def __acquire(self, name):
+        """
+        Locks the mark of the active job of the model. The lock is held by the server process until the job
+        finishes and is released by the system if the process dies, so the model is never blocked by a dead job
+        Returns
+        -------
+        file : file object or None if another job of the model is active
+            Closing the file releases the lock
+        """
+        f = open(self.__active_path(name), "a")
+        if fcntl is not None:
+            try:
+                fcntl.flock(f, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            except BlockingIOError:
+                f.close()
+                return None
+        elif any(job["name"] == name and not job["future"].done() for job in self.__jobs.values()):
+            f.close()
+            return None
+        return f
+
+    def recover(self):
+        """
+        Marks jobs of the previous run of the server as failed, must be called before the server processes start
+        """
+        if not os.path.isdir(self.jobs_directory):
+            return
+        for filename in os.listdir(self.jobs_directory):
+            path = os.path.join(self.jobs_directory, filename)
+            if filename.endswith(".cancel"):
+                os.remove(path)
+            elif filename.endswith(".model.json"):
+                remove_model(path)
+            elif filename.endswith(".json"):
+                status = self.status(filename[:-len(".json")])
+                if status is not None and status["state"] in ("queued", "running"):
+                    status["state"] = "error"
+                    status["error"] = "Server was restarted"
+                    _write_json(path, status)
+
+    def submit(self, name, model_path, X_train, y_train, X_val, y_val, on_done, n_more=None):
+        """
+        Puts fitting of the model into the queue
+        name : str
+            Name of the model, only one job per model can be active
+        model_path : str
+            Path to the metadata file of the model
+        on_done : callable
+            Called in the server process as on_done(result_path) after successful fitting
+        n_more : int
+            If given, the fitted model is extended by this number of trees
+        Returns
+        -------
+        job_id : str or None if the model is already being fitted
+        """
+        return self.__submit(name, on_done, "fit", _run_fit, model_path, X_train, y_train, X_val, y_val, n_more)
+
+    def submit_search(self, name, model_type, candidates, X_train, y_train, X_val, y_val, on_done, **search_params):
+        """
+        Puts hyperparameter search into the queue, the candidates are fitted by a separate pool of processes
+        name : str
+            Name of the model the best candidate is saved as
+        model_type : str
+            rf or bt
+        candidates : list
+            Dicts of parameters of the model constructor
+        on_done : callable
+            Called in the server process as on_done(result_path) with the best model saved at result_path
+        search_params : dict
+            Keyword arguments of hyperparameter_search.search
+        Returns
+        -------
+        job_id : str or None if the model is already being fitted
+        """
+        return self.__submit(name, on_done, "search", _run_search, model_type, candidates, X_train, y_train,
+                             X_val, y_val, search_params)
+
+    def __submit(self, name, on_done, kind, function, *args):
+        with self.__lock:
+            os.makedirs(self.jobs_directory, exist_ok=True)
+            job_id = uuid.uuid4().hex
+            status_path, cancel_path, result_path = self.__paths(job_id)
+            _write_json(status_path, {"state": "queued", "n_estimators": None, "iteration": 0, "hist": None})
+            active = self.__acquire(name)
+            if active is None:
+                os.remove(status_path)
+                return None
+            # the future of the job is completed by the pool future, until then the queued job can be cancelled
+            future = Future()
+            self.__jobs[job_id] = {"name": name, "future": future, "active": active, "slot": None}
+        future.add_done_callback(lambda f: self.__finish(job_id, f, on_done))
+        threading.Thread(target=self.__start, args=(job_id, kind, function, args), daemon=True).start()
+        return job_id
+
+    def __start(self, job_id, kind, function, args):
+        """
+        Waits for a free slot of the job kind in a thread of the server process and passes the job to the pool,
+        so the processes of the pool run only the jobs which hold a slot
+        """
+        status_path, cancel_path, result_path = self.__paths(job_id)
+        job = self.__jobs[job_id]
+        n_slots = self.max_workers if kind == "fit" else self.max_searches
+        slot = None
+        while fcntl is not None and not job["future"].cancelled():
+            slot = _take_slot(os.path.join(self.jobs_directory, kind + "-slot"), n_slots)
+            if slot is not None:
+                break
+            if os.path.exists(cancel_path):
+                # cancelled by another server process
+                job["future"].cancel()
+                break
+            time.sleep(_SLOT_POLL_SECONDS)
+        job["slot"] = slot
+        if not job["future"].set_running_or_notify_cancel():
+            if slot is not None:
+                slot.close()
+            return
+        with self.__lock:
+            if kind not in self.__executors:
+                # without file locks the pool of each kind limits the jobs of the server process
+                self.__executors[kind] = ProcessPoolExecutor(max_workers=n_slots,
+                                                             mp_context=multiprocessing.get_context("spawn"))
+            executor = self.__executors[kind]
+        try:
+            pool_future = executor.submit(function, status_path, cancel_path, result_path, *args)
+        except RuntimeError as error:  # e.g. the pool is broken by a killed process
+            job["future"].set_exception(error)
+            return
+        pool_future.add_done_callback(lambda f: _copy_outcome(f, job["future"]))
+
+    def __finish(self, job_id, future, on_done):
+        status_path, cancel_path, result_path = self.__paths(job_id)
+        status = self.status(job_id) or {"n_estimators": None, "iteration": 0, "hist": None}
+        try:
+            if future.cancelled() or future.result() is None:
+                status["state"] = "cancelled"
+            else:
+                observe_stages(future.result())
+                on_done(result_path)
+                status["state"] = "done"
+        except Exception as error:  # the job must not stay "running" forever
+            status["state"] = "error"
+            status["error"] = str(error)
+        if os.path.exists(cancel_path):
+            os.remove(cancel_path)
+        if os.path.exists(result_path):
+            remove_model(result_path)
+        _write_json(status_path, status)
+        job = self.__jobs[job_id]
+        if job["slot"] is not None:
+            job["slot"].close()
+        job["active"].close()
+
+    def status(self, job_id):
+        """
+        Returns state of the job, its progress and partial fitting history or None for unknown job
+        """
+        status_path = self.__paths(job_id)[0]
+        if not job_id.isalnum() or not os.path.exists(status_path):
+            return None
+        with open(status_path) as f:
+            return json.load(f)
+
+    def cancel(self, job_id):
+        """
+        Stops the job after the current iteration
+        Returns
+        -------
+        False if there is no such active job
+        """
+        with self.__lock:
+            job = self.__jobs.get(job_id)
+            if job is None:
+                # the job may be run by another server process, it checks the cancel file itself
+                status = self.status(job_id)
+                if status is None or status["state"] not in ("queued", "running"):
+                    return False
+                open(self.__paths(job_id)[1], "w").close()
+                return True
+            if job["future"].done():
+                return False
+            open(self.__paths(job_id)[1], "w").close()
+            job["future"].cancel()
+        return True
@@ -0,0 +1,302 @@
+import numpy as np
+try:
+    # private sklearn API, the only place it is used is compiled_tree
+    from sklearn.tree._tree import Tree, NODE_DTYPE
+except ImportError:
+    Tree = NODE_DTYPE = None
+
+
+def compiled_tree(left, right, feature, threshold, depth):
+    """
+    Builds sklearn tree over the nodes of one packed tree, so that its compiled apply can traverse them
+    The tree is restored from the state as unpickling does: Tree(n_features, n_classes, n_outputs) and the node table
+    of NODE_DTYPE. Fields of the table are filled by name, since their set changed between sklearn versions
+    (missing_go_to_left appeared in 1.3, its zero sends nan to the right child as the numpy traversal does)
+    left, right : numpy ndarray
+        Children indexes within the tree, leaves point to themselves
+    feature, threshold, depth
+        The same as in PackedEnsemble
+    Returns
+    -------
+    tree : sklearn.tree._tree.Tree or None if sklearn internals are not as expected
+    """
+    if Tree is None:
+        return None
+    n_nodes = left.shape[0]
+    is_leaf = left == np.arange(n_nodes)
+    try:
+        table = np.zeros(n_nodes, dtype=NODE_DTYPE)
+        table["left_child"] = np.where(is_leaf, -1, left)
+        table["right_child"] = np.where(is_leaf, -1, right)
+        table["feature"] = feature
+        table["threshold"] = threshold
+        # apply does not check columns of X, so the tree knows how many of them its nodes use
+        tree = Tree(int(feature.max()) + 1, np.ones(1, dtype=np.intp), 1)
+        tree.__setstate__({"max_depth": int(depth), "node_count": n_nodes, "nodes": table,
+                           "values": np.zeros((n_nodes, 1, 1))})
+    except (TypeError, ValueError, KeyError):
+        return None
+    return tree
+
+
+def sklearn_tree_arrays(tree, features_indxes):
+    """
+    Returns arrays of fitted sklearn tree in the format of PackedEnsemble.from_trees
+    tree : DecisionTreeRegressor
+        Tree fitted on the columns features_indxes of the original matrix
+    """
+    tree = tree.tree_
+    return (np.asarray(features_indxes)[np.maximum(tree.feature, 0)], tree.threshold,
+            tree.children_left, tree.children_right, tree.value[:, 0, 0], tree.max_depth)
+
+
+class PackedEnsemble:
+    """
+    Weighted sum of decision trees flattened into contiguous numpy arrays
+    """
+    def __init__(self, feature, threshold, left, right, value, roots, depth, compiled=None):
+        """
+        feature : numpy ndarray
+            Column of the original feature matrix used in each node
+        threshold : numpy ndarray
+            Objects with feature value <= threshold go to the left child
+        left, right : numpy ndarray
+            Global indexes of the children. Leaves point to themselves
+        value : numpy ndarray
+            Leaf values already multiplied by the weight of the tree
+        roots : numpy ndarray
+            Index of the root node of each tree
+        depth : int
+            Maximum depth of the trees
+        compiled : list
+            Trees built by compiled_tree for bulk predictions, shared with the ensemble of the same trees
+        """
+        self.feature = feature
+        self.threshold = threshold
+        self.left = left
+        self.right = right
+        self.value = value
+        self.roots = roots
+        self.depth = depth
+        # trees are built on the first bulk prediction and kept, they are private memory of the process
+        # unlike memory-mapped arrays, so only the trees which were needed are built
+        self.__compiled = [None] * roots.shape[0] if compiled is None else compiled
+
+    @classmethod
+    def from_trees(cls, trees, weights):
+        """
+        Builds packed ensemble from arrays of the trees
+        trees : list
+            Tuples (feature, threshold, children_left, children_right, value, depth) for each tree,
+            features are columns of the original matrix, children of leaves are -1
+        weights : list
+            Multiplier of each tree prediction
+        """
+        feature, threshold, left, right, value, roots = [], [], [], [], [], []
+        offset = 0
+        depth = 0
+        for (tree_feature, tree_threshold, children_left, children_right, tree_value, tree_depth), weight \
+                in zip(trees, weights):
+            nodes = np.arange(tree_feature.shape[0])
+            is_leaf = children_left == -1
+            feature.append(np.where(is_leaf, 0, tree_feature))
+            threshold.append(np.where(is_leaf, np.inf, tree_threshold))
+            left.append(np.where(is_leaf, nodes, children_left) + offset)
+            right.append(np.where(is_leaf, nodes, children_right) + offset)
+            value.append(tree_value * weight)
+            roots.append(offset)
+            offset += tree_feature.shape[0]
+            depth = max(depth, tree_depth)
+        if not roots:
+            empty = np.zeros(0, dtype=np.intp)
+            return cls(empty, np.zeros(0), empty, empty, np.zeros(0), empty, 0)
+        return cls(np.concatenate(feature).astype(np.intp), np.concatenate(threshold).astype(np.float64),
+                   np.concatenate(left).astype(np.intp), np.concatenate(right).astype(np.intp),
+                   np.concatenate(value).astype(np.float64), np.array(roots, dtype=np.intp), depth)
+
+    @classmethod
+    def from_sklearn(cls, estimators, features, weights):
+        """
+        Builds packed ensemble from fitted sklearn trees
+        estimators : list
+            Fitted DecisionTreeRegressor objects
+        features : list
+            Indexes of original columns each tree was fitted on
+        weights : list
+            Multiplier of each tree prediction
+        """
+        trees = [sklearn_tree_arrays(tree, features_indxes) for tree, features_indxes in zip(estimators, features)]
+        return cls.from_trees(trees, weights)
+
+    @classmethod
+    def from_table(cls, table, depth):
+        """
+        Builds packed ensemble over the table returned by to_table
+        Arrays are views of the table, so memory-mapped table is read only when the nodes are visited
+        table : numpy ndarray
+            Structured scalar array with all arrays of the ensemble as fields
+        depth : int
+            Maximum depth of the trees
+        """
+        return cls(table["feature"], table["threshold"], table["left"], table["right"], table["value"],
+                   table["roots"], depth)
+
+    @classmethod
+    def concatenate(cls, ensembles):
+        """
+        Builds packed ensemble which sums predictions of the given ones
+        """
+        if not ensembles:
+            return cls.from_trees([], [])
+        offsets = np.cumsum([0] + [ensemble.feature.shape[0] for ensemble in ensembles])
+        return cls(np.concatenate([ensemble.feature for ensemble in ensembles]).astype(np.intp),
+                   np.concatenate([ensemble.threshold for ensemble in ensembles]).astype(np.float64),
+                   np.concatenate([ensemble.left + offset for ensemble, offset in zip(ensembles, offsets)]),
+                   np.concatenate([ensemble.right + offset for ensemble, offset in zip(ensembles, offsets)]),
+                   np.concatenate([ensemble.value for ensemble in ensembles]).astype(np.float64),
+                   np.concatenate([ensemble.roots + offset for ensemble, offset in zip(ensembles, offsets)]),
+                   max(ensemble.depth for ensemble in ensembles))
+
+    def scaled(self, factor):
+        """
+        Returns packed ensemble with the weights of all trees multiplied by factor
+        """
+        return PackedEnsemble(self.feature, self.threshold, self.left, self.right, self.value * factor,
+                              self.roots, self.depth, self.__compiled)
+
+    def to_table(self):
+        """
+        Returns all arrays of the ensemble as fields of one structured scalar, which is saved into a single .npy file
+        Each field is a contiguous block of the file, so the arrays can be memory-mapped without copying
+        """
+        n_nodes = self.feature.shape[0]
+        fields = [("feature", "<i8", n_nodes), ("threshold", "<f8", n_nodes), ("left", "<i8", n_nodes),
+                  ("right", "<i8", n_nodes), ("value", "<f8", n_nodes), ("roots", "<i8", self.n_trees)]
+        table = np.empty((), dtype=[(name, dtype, (size,)) for name, dtype, size in fields])
+        for name, _, _ in fields:
+            table[name] = getattr(self, name)
+        return table
+
+    @property
+    def n_trees(self):
+        """
+        The number of packed trees
+        """
+        return self.roots.shape[0]
+
+    def prefix(self, n_trees):
+        """
+        Returns packed ensemble of the first n_trees trees
+        Nodes of the trees are stored one tree after another, so the arrays are views and nothing is copied
+        """
+        if n_trees >= self.n_trees:
+            return self
+        end = self.roots[n_trees]
+        return PackedEnsemble(self.feature[:end], self.threshold[:end], self.left[:end], self.right[:end],
+                              self.value[:end], self.roots[:n_trees], self.depth, self.__compiled)
+
+    def predict(self, X, batch_size=None):
+        """
+        Evaluates all trees for a batch of objects at once
+        X : numpy ndarray
+            Array of size n_objects, n_features
+        batch_size : int
+            The number of objects traversed together by numpy, bulk predictions use compiled traversal of each tree.
+            By default about a million (object, tree) pairs
+        Returns
+        -------
+        y : numpy ndarray
+            Array of size n_objects with sum of the weighted tree predictions
+        """
+        # trees compare float32 features with thresholds exactly as sklearn does
+        X = np.ascontiguousarray(X, dtype=np.float32)
+        preds = np.zeros(X.shape[0])
+        self.__add_predictions(X, 0, self.n_trees, preds, batch_size)
+        return preds
+
+    def staged_predict(self, X, step=1, batch_size=None):
+        """
+        Evaluates the trees block by block in the order they were added
+        X : numpy ndarray
+            Array of size n_objects, n_features
+        step : int
+            The number of trees in a block
+        Yields
+        ------
+        n_trees : int
+            The number of trees evaluated so far
+        y : numpy ndarray
+            Array of size n_objects with sum of the weighted predictions of the first n_trees trees
+        """
+        X = np.ascontiguousarray(X, dtype=np.float32)
+        preds = np.zeros(X.shape[0])
+        for begin in range(0, self.n_trees, step):
+            end = min(begin + step, self.n_trees)
+            self.__add_predictions(X, begin, end, preds, batch_size)
+            yield end, preds.copy()
+
+    def __tree_end(self, index):
+        """
+        Returns the index after the last node of the tree
+        """
+        return self.roots[index + 1] if index + 1 < self.n_trees else self.feature.shape[0]
+
+    def __add_predictions(self, X, begin, end, preds, batch_size):
+        """
+        Adds predictions of the trees with indexes from begin to end to preds
+        Small batches are traversed by numpy. Bulk predictions use compiled traversal of sklearn trees,
+        building them pays off when there are more (object, tree) pairs than nodes
+        """
+        if begin == end:
+            return
+        n_nodes = self.__tree_end(end - 1) - self.roots[begin]
+        if n_nodes <= 2 * X.shape[0] * (end - begin) and self.__add_compiled_predictions(X, begin, end, preds):
+            return
+        if batch_size is None:
+            batch_size = max(1, 2 ** 20 // (end - begin))
+        roots = self.roots[begin:end]
+        flat = X.ravel()
+        for batch_begin in range(0, X.shape[0], batch_size):
+            n_objects = min(batch_size, X.shape[0] - batch_begin)
+            # (object, tree) pairs as the position of the object row in flat X and the current node
+            offsets = np.repeat(np.arange(batch_begin, batch_begin + n_objects) * X.shape[1], roots.shape[0])
+            nodes = np.tile(roots, n_objects)
+            batch_preds = np.zeros(n_objects)
+            while nodes.shape[0]:
+                # leaves point to themselves, the pairs which reached them are summed up and dropped
+                is_leaf = self.left[nodes] == nodes
+                if is_leaf.any():
+                    rows = offsets[is_leaf] // X.shape[1] - batch_begin
+                    batch_preds += np.bincount(rows, self.value[nodes[is_leaf]], minlength=n_objects)
+                    nodes, offsets = nodes[~is_leaf], offsets[~is_leaf]
+                feature = self.feature[nodes]
+                # flat X would silently read the next object for a column which X does not have
+                if feature.shape[0] and feature.max() >= X.shape[1]:
+                    raise IndexError(f"Trees use {feature.max() + 1} features, X has {X.shape[1]}")
+                go_left = flat[offsets + feature] <= self.threshold[nodes]
+                nodes = np.where(go_left, self.left[nodes], self.right[nodes])
+            preds[batch_begin:batch_begin + n_objects] += batch_preds
+
+    def __add_compiled_predictions(self, X, begin, end, preds):
+        """
+        Adds predictions of the trees with indexes from begin to end to preds using compiled sklearn trees
+        Returns
+        -------
+        False if the trees cannot be built with the installed sklearn, preds are not changed then
+        """
+        trees = []
+        for index in range(begin, end):
+            if self.__compiled[index] is None:
+                root, tree_end = self.roots[index], self.__tree_end(index)
+                self.__compiled[index] = compiled_tree(self.left[root:tree_end] - root,
+                                                       self.right[root:tree_end] - root, self.feature[root:tree_end],
+                                                       self.threshold[root:tree_end], self.depth)
+                if self.__compiled[index] is None:
+                    return False
+            if self.__compiled[index].n_features > X.shape[1]:
+                raise IndexError(f"Trees use {self.__compiled[index].n_features} features, X has {X.shape[1]}")
+            trees.append(self.__compiled[index])
+        for index, tree in zip(range(begin, end), trees):
+            root = self.roots[index]
+            preds += self.value[root:root + tree.node_count][tree.apply(X)]
+        return True
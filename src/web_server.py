@@ -1,21 +1,121 @@
+import io
 import os
-import pickle
+import json
+import time
+import sqlite3
 import pandas as pd
 import numpy as np
-from flask import Flask, render_template, request
+from flask import Flask, Response, g, render_template, request
 from flask_sqlalchemy import SQLAlchemy
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+from sqlalchemy.pool import QueuePool
+from concurrent.futures import ThreadPoolExecutor
+from functools import partial
 import flask_excel as excel
 import plotly.graph_objs as go
-from ensembles import RandomForestMSE, GradientBoostingMSE
+from ensembles import RandomForestMSE, GradientBoostingMSE, rmse
+from model_cache import ModelCache
+from micro_batcher import MicroBatcher
+from data_io import upload_format, read_table, write_predictions, write_columns
+from model_format import save_model, load_metadata, move_model, remove_model, migrate_pickle
+from training_jobs import TrainingJobs
+from hyperparameter_search import SEARCH_PARAMS, candidate_params
+from metrics import registry, stage, start_collecting, stop_collecting, summarize
 
 
 app = Flask(__name__, template_folder='templates', static_folder='static')
 app.config['BOOTSTRAP_SERVE_LOCAL'] = True
 app.config['SQLALCHEMY_DATABASE_URI'] = 'sqlite:///database.sqlite'
 app.config['SQLALCHEMY_TRACK_MODIFICATIONS'] = False
+# several server processes read the database concurrently, connections wait for the lock instead of failing
+app.config['SQLITE_BUSY_TIMEOUT_MS'] = 30000
+app.config['SQLALCHEMY_ENGINE_OPTIONS'] = {
+    'poolclass': QueuePool,
+    'pool_size': 5,
+    'max_overflow': 10,
+    'connect_args': {'timeout': app.config['SQLITE_BUSY_TIMEOUT_MS'] / 1000, 'check_same_thread': False}
+}
+app.config['MODEL_CACHE_MAX_ENTRIES'] = 16
+app.config['MODEL_CACHE_MAX_BYTES'] = 512 * 1024 ** 2
+# the number of models fitted at once by all server processes together, the jobs above it wait in the queue
+app.config['TRAINING_WORKERS'] = 2
+app.config['PREDICT_CHUNK_ROWS'] = 100000
+# trees compare features in float32, so reading them as float32 does not change the models and halves memory
+app.config['FEATURES_DTYPE'] = 'float32'
+app.config['BATCH_MAX_SIZE'] = 256
+app.config['BATCH_MAX_WAIT_MS'] = 2
+# the number of models scored simultaneously by /predict_models
+app.config['SCORING_THREADS'] = os.cpu_count() or 1
+# the number of searches run at once by all server processes, the number of processes fitting candidates
+# of each search and the maximum number of candidates
+app.config['SEARCH_JOBS'] = 1
+app.config['SEARCH_WORKERS'] = os.cpu_count() or 1
+app.config['SEARCH_MAX_CANDIDATES'] = 200
+# durations of the stages are returned in Server-Timing header of every response,
+# otherwise only of the requests with X-Request-Timing header
+app.config['TIMING_HEADER'] = False
 db = SQLAlchemy(app)
 models_directory = os.path.join(os.path.dirname(__file__), "instance/models")
+metrics_directory = os.path.join(os.path.dirname(__file__), "instance/metrics")
+model_cache = ModelCache(app.config['MODEL_CACHE_MAX_ENTRIES'], app.config['MODEL_CACHE_MAX_BYTES'])
+micro_batcher = MicroBatcher(app.config['BATCH_MAX_SIZE'], app.config['BATCH_MAX_WAIT_MS'])
+training_jobs = TrainingJobs(os.path.join(os.path.dirname(__file__), "instance/jobs"),
+                             app.config['TRAINING_WORKERS'], app.config['SEARCH_JOBS'])
 excel.init_excel(app)
+REQUESTS_TOTAL = registry.counter("http_requests_total", "Number of processed requests", ["endpoint", "status"])
+REQUEST_SECONDS = registry.histogram("http_request_duration_seconds", "Duration of the requests", ["endpoint"])
+
+
+@event.listens_for(Engine, "connect")
+def configure_sqlite(dbapi_connection, connection_record):
+    """
+    Switches SQLite to write-ahead log, so readers of the models table are not blocked by writers
+    """
+    if isinstance(dbapi_connection, sqlite3.Connection):
+        cursor = dbapi_connection.cursor()
+        cursor.execute(f"PRAGMA busy_timeout = {int(app.config['SQLITE_BUSY_TIMEOUT_MS'])}")
+        cursor.execute("PRAGMA journal_mode = WAL")
+        cursor.execute("PRAGMA synchronous = NORMAL")
+        cursor.close()
+
+
+def prepare_workers(preload_models=True):
+    """
+    Prepares the server before worker processes are forked from the current one
+    Models pickled by the previous versions are converted into native format
+    preload_models : bool
+        If True, the fitted models are loaded, so the workers start with filled cache.
+        Trees are memory-mapped, so all workers use the same physical pages of the model files
+    """
+    with app.app_context():
+        db.create_all()
+        for model in Model.query.all():
+            try:
+                model.ensure_native()
+            except LegacyModelError:
+                # the model stays unreadable, its requests return the error, the other models are served
+                continue
+            if preload_models and model.is_fitted:
+                try:
+                    model.load()
+                except (OSError, ValueError, KeyError):
+                    continue
+        # connections must not be shared by the forked processes
+        db.engine.dispose()
+    training_jobs.recover()
+    if os.path.isdir(metrics_directory):
+        for filename in os.listdir(metrics_directory):
+            os.remove(os.path.join(metrics_directory, filename))
+
+
+def init_worker():
+    """
+    Prepares the worker process after it is forked
+    """
+    with app.app_context():
+        db.engine.dispose(close=False)
+    registry.share(metrics_directory)
 
 
 def build_plot(hist):
@@ -29,6 +129,12 @@ def build_plot(hist):
     if 'val-loss' in hist:
         fig.add_trace(go.Scatter(x=iters, y=hist['val-loss'],
                                  mode="lines+markers", name="RMSE на валидационной выборке"))
+    if 'oob-loss' in hist:
+        fig.add_trace(go.Scatter(x=iters, y=hist['oob-loss'],
+                                 mode="lines+markers", name="RMSE out-of-bag"))
+    if 'best-iteration' in hist:
+        fig.add_vline(x=hist['best-iteration'], line_dash="dash", line_color="gray",
+                      annotation_text="Лучшая итерация", annotation_position="top right")
     fig.update_layout(
                       showlegend=True,
                       legend=dict(x=.5, xanchor="center"),
@@ -47,10 +153,55 @@ def build_plot(hist):
                           'font': {'size': 18}
                       },
                       margin=dict(l=0, r=0, t=30, b=0))
-    fig.update_traces(hoverinfo="all", hovertemplate="Итерация: %{x}<br> RMSE: %{y}")
+    # losses may be computed not on every iteration, the points are connected over the skipped ones
+    fig.update_traces(hoverinfo="all", hovertemplate="Итерация: %{x}<br> RMSE: %{y}", connectgaps=True)
     return fig.to_json()
 
 
+def detach_upload(storage):
+    """
+    Returns file object of the uploaded file which stays open after the request is closed
+    """
+    try:
+        return os.fdopen(os.dup(storage.stream.fileno()), "rb")
+    except (AttributeError, OSError, io.UnsupportedOperation):
+        return io.BytesIO(storage.read())
+
+
+def stream_predictions(predict, preds, chunks, file, column_name):
+    """
+    Yields predictions in csv format chunk by chunk
+    predict : callable
+        Makes predictions for the chunks
+    preds : numpy ndarray
+        Predictions for the first chunk which is already processed
+    chunks : iterator
+        The rest of the data as pandas DataFrames
+    file : file object
+        The file chunks are read from, it is closed in the end
+    """
+    with file:
+        yield pd.DataFrame({column_name: preds}).to_csv(index=False)
+        for chunk in chunks:
+            preds = predict(np.asarray(chunk, dtype=app.config['FEATURES_DTYPE']))
+            yield pd.DataFrame({column_name: preds}).to_csv(index=False, header=False)
+
+
+class LegacyModelError(Exception):
+    """
+    Raised when the model pickled by the previous versions cannot be converted into native format
+    """
+
+
+@app.errorhandler(LegacyModelError)
+def legacy_model_error(error):
+    """
+    Returns error for the requests to the model which cannot be read
+    """
+    return ["Error", f"Модель {error} сохранена в устаревшем формате и не может быть прочитана, "
+                     "удалите ее и создайте заново!"]
+
+
 class Model(db.Model):
     """
     Class for model representation
@@ -67,7 +218,7 @@ class Model(db.Model):
         Model initiation
         """
         self.name = name
-        self.filename = name + '.pickle'
+        self.filename = name + '.json'
         self.model_type = model_type
         self.description = description
         self.data_descr = ''
@@ -77,27 +228,48 @@ class Model(db.Model):
         """Model representation: name and type (rf for RandomForest and bt for GradientBoosting"""
         return str((self.name, self.model_type))
 
-    def fit(self, X_train, y_train, X_val, y_val, descr):
+    def load(self):
+        """
+        Returns model and its fitting history, reading the file only if it is not cached
+        """
+        self.ensure_native()
+        with stage("load"):
+            return model_cache.get(self.name, os.path.join(models_directory, self.filename))
+
+    def fit(self, X_train, y_train, X_val, y_val, descr, n_more=None):
         """
-        Model fitting and saving results of it
+        Starts model fitting in background, results are saved when it completes
+        n_more : int
+            If given, the fitted model is extended by this number of trees instead of fitting from scratch
+        Returns
+        -------
+        job_id : str or None if the model is already being fitted
         """
-        self.data_descr = descr
-        self.is_fitted = True
-        data = None
-        with open(os.path.join(models_directory, self.filename), "rb") as f:
-            data = pickle.load(f)
-        hist = data['model'].fit(X_train, y_train, X_val, y_val)
-        with open(os.path.join(models_directory, self.filename), "wb") as f:
-            pickle.dump({"model": data['model'], "hist": hist}, f)
+        self.ensure_native()
+        name = self.name
+        path = os.path.join(models_directory, self.filename)
+
+        def save_results(result_path):
+            with app.app_context():
+                model = Model.query.filter(Model.name == name).first()
+                if not model:
+                    return
+                with stage("persist"):
+                    move_model(result_path, path)
+                model_cache.invalidate(name)
+                model.data_descr = descr
+                model.is_fitted = True
+                db.session.add(model)
+                db.session.commit()
+
+        with stage("submit"):
+            return training_jobs.submit(name, path, X_train, y_train, X_val, y_val, save_results, n_more)
 
     def predict(self, X):
         """
         Making predictions with fitted model
         """
-        with open(os.path.join(models_directory, self.filename), "rb") as f:
-            data = pickle.load(f)
-            preds = data["model"].predict(X)
-        return preds
+        return self.load()["model"].predict(X)
 
     def get_information(self):
         """
@@ -110,13 +282,87 @@ class Model(db.Model):
             'is_fitted': self.is_fitted,
             'data_descr': self.data_descr
         }
-        with open(os.path.join(models_directory, self.filename), "rb") as f:
-            data = pickle.load(f)
-            if self.is_fitted:
-                result['plot'] = build_plot(data['hist'])
-            result['params'] = data['model'].get_params(deep=False)
+        self.ensure_native()
+        # only the metadata file is read, trees are not needed here
+        with stage("load"):
+            meta = load_metadata(os.path.join(models_directory, self.filename))
+        if self.is_fitted:
+            with stage("render"):
+                result['plot'] = build_plot(meta['hist'])
+        result['params'] = {key: value for key, value in meta['params'].items() if key != 'trees_params'}
+        if meta.get('leaderboard'):
+            result['leaderboard'] = meta['leaderboard']
         return result
 
+    def migrate(self):
+        """
+        Converts the model saved as pickle into native format
+        Returns
+        -------
+        False if the model is already in native format
+        """
+        if not self.filename.endswith('.pickle'):
+            return False
+        filename = self.name + '.json'
+        migrate_pickle(os.path.join(models_directory, self.filename), os.path.join(models_directory, filename))
+        model_cache.invalidate(self.name)
+        self.filename = filename
+        return True
+
+    def ensure_native(self):
+        """
+        Converts the model pickled by the previous versions into native format and saves the new filename,
+        raises LegacyModelError if the pickle cannot be read
+        """
+        if not self.filename.endswith('.pickle'):
+            return
+        try:
+            self.migrate()
+            db.session.commit()
+        except Exception as error:
+            # unpickling old classes may fail in many ways, e.g. with AttributeError or ModuleNotFoundError
+            db.session.rollback()
+            raise LegacyModelError(self.name) from error
+
+
+@app.before_request
+def start_timing():
+    """
+    Starts collecting durations of the stages of the request
+    """
+    g.start_time = time.perf_counter()
+    start_collecting()
+    # models fitted or deleted by other worker processes are dropped from the cache of this one
+    model_cache.refresh(models_directory)
+
+
+@app.after_request
+def finish_timing(response):
+    """
+    Updates request metrics and adds Server-Timing header with durations of the stages in milliseconds
+    """
+    events = stop_collecting()
+    if 'start_time' not in g:
+        return response
+    endpoint = request.endpoint or "unknown"
+    REQUESTS_TOTAL.inc(endpoint=endpoint, status=str(response.status_code))
+    REQUEST_SECONDS.observe(time.perf_counter() - g.start_time, endpoint=endpoint)
+    registry.save()
+    if app.config['TIMING_HEADER'] or request.headers.get('X-Request-Timing'):
+        stages = summarize(events)
+        stages["total"] = time.perf_counter() - g.start_time
+        response.headers['Server-Timing'] = ", ".join(f"{name};dur={seconds * 1000:.3f}"
+                                                      for name, seconds in stages.items())
+    return response
+
+
+@app.route("/metrics", methods=["GET"])
+def metrics():
+    """
+    Returns counters and histograms of the server in Prometheus text format
+    """
+    return Response(registry.render(), mimetype="text/plain; version=0.0.4")
+
 
 @app.route("/")
 def start_page():
@@ -169,6 +415,24 @@ def add_model():
             data["model_lr"] = float(data["model_lr"])
             if data["model_lr"] <= 0:
                 return ["Error", "Learning rate должен быть положительным числом!"]
+        if not data.get("model_patience"):
+            data["model_patience"] = None
+        else:
+            data["model_patience"] = int(data["model_patience"])
+            if data["model_patience"] <= 0:
+                return ["Error", "Число итераций без улучшения должно быть положительным числом!"]
+        if not data.get("model_eval_period"):
+            data["model_eval_period"] = 1
+        else:
+            data["model_eval_period"] = int(data["model_eval_period"])
+            if data["model_eval_period"] <= 0:
+                return ["Error", "Период подсчета ошибки должен быть положительным числом!"]
+        if not data.get("model_eval_subsample"):
+            data["model_eval_subsample"] = None
+        else:
+            data["model_eval_subsample"] = float(data["model_eval_subsample"])
+            if data["model_eval_subsample"] > 1 or data["model_eval_subsample"] <= 0:
+                return ["Error", "Доля объектов для подсчета ошибки не может быть больше 1 или меньше или равной 0!"]
         model = Model.query.filter(Model.name == data["model_name"]).first()
         if model:
             return ["Error", "Модель с таким именем уже существует!"]
@@ -176,12 +440,20 @@ def add_model():
         md = None
         if data["model_type"] == 'bt':
             md = GradientBoostingMSE(data["model_est"], data["model_lr"],
-                                     data["model_depth"], data["model_features"])
+                                     data["model_depth"], data["model_features"],
+                                     histogram=bool(data.get("model_histogram")),
+                                     early_stopping_rounds=data["model_patience"],
+                                     eval_period=data["model_eval_period"],
+                                     eval_subsample=data["model_eval_subsample"])
         elif data["model_type"] == 'rf':
-            md = RandomForestMSE(data["model_est"], data["model_depth"], data["model_features"])
+            md = RandomForestMSE(data["model_est"], data["model_depth"], data["model_features"],
+                                 early_stopping_rounds=data["model_patience"],
+                                 eval_period=data["model_eval_period"],
+                                 eval_subsample=data["model_eval_subsample"],
+                                 oob_loss=bool(data.get("model_oob")))
         if md:
-            with open(os.path.join(models_directory, data["model_name"] + ".pickle"), "wb") as f:
-                pickle.dump({"model": md, "hist": None}, f)
+            with stage("persist"):
+                save_model(md, None, os.path.join(models_directory, model.filename))
         else:
             return ["Error", "Проверьте корректность введенных данных!"]
         db.session.add(model)
@@ -201,7 +473,8 @@ def delete_model():
         model = Model.query.filter(Model.name == name).first()
         if not model:
             return ["Error", "Модели с таким именем не существует!"]
-        os.remove(os.path.join(models_directory, model.filename))
+        remove_model(os.path.join(models_directory, model.filename))
+        model_cache.invalidate(model.name)
         db.session.delete(model)
         db.session.commit()
         return ["OK"]
@@ -209,57 +482,247 @@ def delete_model():
         return ["Error", "Некорректный запрос на удаление!"]
 
 
-@app.route("/fit_model", methods=["POST"])
-def fit_model():
+def read_upload(name):
     """
-    Model fitting with data given in request
+    Reads the uploaded table in any supported format
+    name : str
+        Name of the file field of the request
+    Returns
+    -------
+    data : pandas DataFrame
+    data_format : str
     """
+    storage = request.files.get(name)
+    if storage is None:
+        raise ValueError
+    data_format = upload_format(storage)
+    with stage("parse"):
+        return read_table(storage, data_format), data_format
+
+
+def read_fit_data():
+    """
+    Reads train and optional validation samples given in request in csv, npy, npz, parquet or arrow format
+    Returns
+    -------
+    error : list or None
+        Response with error if the data is incorrect
+    data : tuple
+        X_train, y_train, X_val, y_val
+    """
+    if 'target' not in request.form:
+        return ["Error", "Укажите целевую колонку!"], None
+    target = request.form['target']
+    dtype = app.config['FEATURES_DTYPE']
     try:
-        if 'target' not in request.form:
-            return ["Error", "Укажите целевую колонку!"]
-        target = request.form['target']
-        try:
-            data = pd.read_csv(request.files.get('train'))
+        data, _ = read_upload('train')
+        with stage("parse"):
             y_train = np.array(data[target])
-            X_train = np.array(data.drop(labels=[target], axis=1))
+            X_train = np.asarray(data.drop(labels=[target], axis=1), dtype=dtype)
+    except ImportError:
+        return ["Error", "Для чтения этого формата на сервере должен быть установлен pyarrow"], None
+    except ValueError:
+        return ["Error", "Добавьте обучающую выборку!"], None
+    except KeyError:
+        return ["Error", f"Колонка {target} с таргетом отсутствует в обучающей выборке"], None
+    X_val = None
+    y_val = None
+    if 'val' in request.files:
+        try:
+            val, _ = read_upload('val')
+            with stage("parse"):
+                y_val = np.array(val[target])
+                X_val = np.asarray(val.drop(labels=[target], axis=1), dtype=dtype)
+        except ImportError:
+            return ["Error", "Для чтения этого формата на сервере должен быть установлен pyarrow"], None
         except ValueError:
-            return ["Error", "Добавьте обучающую выборку!"]
+            return ["Error", "Проверьте корректность валидационной выборки"], None
         except KeyError:
-            return ["Error", f"Колонка {target} с таргетом отсутствует в обучающей выборке"]
-        X_val = None
-        y_val = None
-        if 'val' in request.files:
-            try:
-                val = pd.read_csv(request.files.get('val'))
-                y_val = np.array(val[target])
-                X_val = np.array(val.drop(labels=[target], axis=1))
-            except ValueError:
-                return ["Error", "Проверьте корректность валидационной выборки"]
-            except KeyError:
-                return ["Error", f"Колонка {target} отсутствует в вадидационной выборке"]
+            return ["Error", f"Колонка {target} отсутствует в вадидационной выборке"], None
+    return None, (X_train, y_train, X_val, y_val)
+
+
+@app.route("/fit_model", methods=["POST"])
+def fit_model():
+    """
+    Model fitting with data given in request
+    """
+    try:
+        error, data = read_fit_data()
+        if error:
+            return error
         if 'model' not in request.form:
             return ["Error", "Выберете модель, которую хотите обучить!"]
         model = Model.query.filter(Model.name == request.form['model']).first()
         if not model:
             return ["Error", "Такой модели не существует!"]
-        model.fit(X_train, y_train, X_val, y_val, request.form['data_description'])
-        db.session.add(model)
-        db.session.commit()
-        return ["OK"]
+        job_id = model.fit(*data, request.form['data_description'])
+        if not job_id:
+            return ["Error", "Модель уже обучается!"]
+        return ["OK", job_id]
     except (ValueError, TypeError, RuntimeError):
         return ["Error", "Не удалось обучить модель. Проверьте корректность введенных данных"]
 
 
+@app.route("/continue_fit", methods=["POST"])
+def continue_fit():
+    """
+    Adding trees to the fitted model with data given in request
+    """
+    try:
+        error, data = read_fit_data()
+        if error:
+            return error
+        if 'model' not in request.form:
+            return ["Error", "Выберете модель, которую хотите дообучить!"]
+        model = Model.query.filter(Model.name == request.form['model']).first()
+        if not model:
+            return ["Error", "Такой модели не существует!"]
+        if not model.is_fitted:
+            return ["Error", "Модель еще не обучена!"]
+        n_estimators = int(request.form.get('n_estimators', ''))
+        if n_estimators <= 0:
+            return ["Error", "Число новых деревьев должно быть положительным числом!"]
+        descr = request.form.get('data_description') or model.data_descr
+        job_id = model.fit(*data, descr, n_more=n_estimators)
+        if not job_id:
+            return ["Error", "Модель уже обучается!"]
+        return ["OK", job_id]
+    except (ValueError, TypeError, RuntimeError):
+        return ["Error", "Не удалось дообучить модель. Проверьте корректность введенных данных"]
+
+
+@app.route("/search_model", methods=["POST"])
+def search_model():
+    """
+    Hyperparameter search with data given in request. The data is read once, the candidates are fitted
+    in parallel and the best of them is added as a new fitted model with the leaderboard of the search
+    Form fields: train, val, target, data_description as in /fit_model, model_name, model_type, model_descr,
+    space - json with lists of values of n_estimators, learning_rate, max_depth and feature_subsample_size
+    or with ranges {"low": a, "high": b} for random search, method - grid or random,
+    n_candidates - the number of candidates of random search, prune - 0 disables early stopping of losing candidates
+    """
+    try:
+        name = request.form.get('model_name')
+        model_type = request.form.get('model_type')
+        if not name:
+            return ["Error", "Укажите название модели!"]
+        if model_type not in SEARCH_PARAMS:
+            return ["Error", "Проверьте корректность введенных данных!"]
+        if Model.query.filter(Model.name == name).first():
+            return ["Error", "Модель с таким именем уже существует!"]
+        try:
+            space = json.loads(request.form.get('space', ''))
+            if not isinstance(space, dict):
+                raise ValueError
+        except ValueError:
+            return ["Error", "Укажите пространство поиска в формате json!"]
+        unknown = set(space) - set(SEARCH_PARAMS[model_type])
+        if unknown:
+            return ["Error", f"Параметры {', '.join(sorted(unknown))} не поддерживаются поиском!"]
+        if 'n_estimators' not in space:
+            return ["Error", "Укажите значения числа деревьев!"]
+        try:
+            candidates = candidate_params(space, request.form.get('method', 'grid'),
+                                          int(request.form.get('n_candidates') or 10))
+            # the same rules as in /add_model, so a bad candidate is rejected before the search starts
+            for params in candidates:
+                if not isinstance(params['n_estimators'], int) or params['n_estimators'] <= 0:
+                    raise ValueError
+                max_depth = params.get('max_depth')
+                if max_depth is not None and (not isinstance(max_depth, int) or max_depth <= 0):
+                    return ["Error", "Глубина деревьев должна быть положительным числом!"]
+                features = params.get('feature_subsample_size')
+                if features is not None and (features > 1 or features <= 0):
+                    return ["Error", "Размерность признаков не может быть больше 1 или меньше или равной 0!"]
+                if params.get('learning_rate', 0.1) <= 0:
+                    return ["Error", "Learning rate должен быть положительным числом!"]
+        except (ValueError, TypeError, KeyError):
+            return ["Error", "Проверьте корректность пространства поиска!"]
+        if not candidates or len(candidates) > app.config['SEARCH_MAX_CANDIDATES']:
+            return ["Error", f"Число кандидатов должно быть от 1 до {app.config['SEARCH_MAX_CANDIDATES']}!"]
+        error, data = read_fit_data()
+        if error:
+            return error
+        descr = request.form.get('model_descr', '')
+        data_descr = request.form.get('data_description', '')
+
+        def register_best(result_path):
+            with app.app_context():
+                if Model.query.filter(Model.name == name).first():
+                    raise RuntimeError(f"Model {name} already exists")
+                model = Model(name, model_type, descr)
+                with stage("persist"):
+                    move_model(result_path, os.path.join(models_directory, model.filename))
+                model.data_descr = data_descr
+                model.is_fitted = True
+                db.session.add(model)
+                db.session.commit()
+
+        with stage("submit"):
+            job_id = training_jobs.submit_search(name, model_type, candidates, *data, register_best,
+                                                 n_jobs=app.config['SEARCH_WORKERS'],
+                                                 prune=request.form.get('prune', '1') != '0')
+        if not job_id:
+            return ["Error", "Модель уже обучается!"]
+        return ["OK", job_id]
+    except (ValueError, TypeError, RuntimeError):
+        return ["Error", "Не удалось запустить поиск. Проверьте корректность введенных данных"]
+
+
+@app.route("/get_fit_status", methods=["GET"])
+def get_fit_status():
+    """
+    Returns state of the fitting job and the fitting history produced so far
+    """
+    status = training_jobs.status(request.args.get('job_id', ''))
+    if status is None:
+        return ["Error", "Такого задания на обучение не существует!"]
+    if status["hist"]:
+        with stage("render"):
+            status["plot"] = build_plot(status["hist"])
+    return ["OK", status]
+
+
+@app.route("/cancel_fit", methods=["GET"])
+def cancel_fit():
+    """
+    Stops fitting job after the current iteration
+    """
+    if not training_jobs.cancel(request.args.get('job_id', '')):
+        return ["Error", "Обучение уже завершено или не существует!"]
+    return ["OK"]
+
+
 @app.route("/predict", methods=["POST"])
 def predict():
     """
-    Making prediction to the given data
+    Making prediction to the given data in csv, npy, npz, parquet or arrow format,
+    predictions are returned in the same format
+    If stream is given, csv data is read and predicted by chunks, so memory does not depend on its size
+    max_trees limits the number of used trees, time_budget_ms limits time of prediction of the data
+    or of each chunk, so the latency can be traded for accuracy without refitting
     """
     try:
+        dtype = app.config['FEATURES_DTYPE']
+        chunks = None
         try:
-            data = pd.read_csv(request.files.get('test'))
-            X_test = np.array(data)
-        except ValueError:
+            if 'test' not in request.files:
+                raise ValueError
+            data_format = upload_format(request.files['test'])
+            stream = request.form.get('stream') and data_format == 'csv'
+            if stream:
+                file = detach_upload(request.files['test'])
+                with stage("parse"):
+                    chunks = pd.read_csv(file, chunksize=app.config['PREDICT_CHUNK_ROWS'])
+                    X_test = np.asarray(next(chunks), dtype=dtype)
+            else:
+                data = read_upload('test')[0]
+                with stage("parse"):
+                    X_test = np.asarray(data, dtype=dtype)
+        except ImportError:
+            return ["Error", "Для чтения этого формата на сервере должен быть установлен pyarrow"]
+        except (ValueError, StopIteration):
             return ["Error", "Добавьте данные для предсказания!"]
         if 'model' not in request.form:
             return ["Error", "Выберете модель, с помощью которой хотите получить предсказания!"]
@@ -270,18 +733,130 @@ def predict():
             return ["Error", "Такой модели не существует!"]
         if not model.is_fitted:
             return ["Error", "Модель еще не обучена!"]
+        limits = {}
+        if request.form.get('max_trees'):
+            limits['max_trees'] = int(request.form['max_trees'])
+            if limits['max_trees'] <= 0:
+                return ["Error", "Число деревьев должно быть положительным числом!"]
+        if request.form.get('time_budget_ms'):
+            limits['time_budget'] = float(request.form['time_budget_ms']) / 1000
+            if limits['time_budget'] <= 0:
+                return ["Error", "Ограничение времени должно быть положительным числом!"]
         try:
-            preds = model.predict(X_test)
-        except (ValueError, TypeError, RuntimeError):
+            predict = partial(model.load()["model"].predict, **limits)
+            preds = predict(X_test)
+        except (ValueError, TypeError, RuntimeError, IndexError):
             return ["Error",
                     "Неправильный формат данных, убедитесь, что они соответствуют данным, на которых обучалась модель "]
-        filename = request.form['model'] + "_predictions.csv"
-        data = {request.form['column_name']: list(preds)}
-        return excel.make_response_from_dict(data, file_type="csv", file_name=filename)
+        filename = request.form['model'] + "_predictions." + data_format
+        if stream:
+            rows = stream_predictions(predict, preds, chunks, file, request.form['column_name'])
+            return Response(rows, mimetype="text/csv",
+                            headers={"Content-Disposition": f"attachment; filename={filename}"})
+        with stage("render"):
+            if data_format != 'csv':
+                content, mimetype = write_predictions(preds, request.form['column_name'], data_format)
+                return Response(content, mimetype=mimetype,
+                                headers={"Content-Disposition": f"attachment; filename={filename}"})
+            data = {request.form['column_name']: list(preds)}
+            return excel.make_response_from_dict(data, file_type="csv", file_name=filename)
+    except (ValueError, TypeError, RuntimeError):
+        return ["Error", "Не удалось получить предсказания. Проверьте корректность введенных данных"]
+
+
+@app.route("/predict_models", methods=["POST"])
+def predict_models():
+    """
+    Making predictions of several models to the same data in csv, npy, npz, parquet or arrow format.
+    Models are given as repeated form field models, the data is read once and the models are scored in parallel.
+    Predictions are returned in the same format with one column per model.
+    If target is given, the column is excluded from the features and RMSE of each model is returned
+    in X-RMSE header as json
+    """
+    try:
+        dtype = app.config['FEATURES_DTYPE']
+        try:
+            data, data_format = read_upload('test')
+        except ImportError:
+            return ["Error", "Для чтения этого формата на сервере должен быть установлен pyarrow"]
+        except ValueError:
+            return ["Error", "Добавьте данные для предсказания!"]
+        names = list(dict.fromkeys(request.form.getlist('models')))
+        if not names:
+            return ["Error", "Выберете модели, с помощью которых хотите получить предсказания!"]
+        target = request.form.get('target')
+        y = None
+        with stage("parse"):
+            if target:
+                if target not in data:
+                    return ["Error", f"Колонка {target} с таргетом отсутствует в данных"]
+                y = np.asarray(data[target], dtype=np.float64)
+                data = data.drop(labels=[target], axis=1)
+            X = np.asarray(data, dtype=dtype)
+        if X.size == 0:
+            return ["Error", "Добавьте данные для предсказания!"]
+        predictors = {}
+        for name in names:
+            model = Model.query.filter(Model.name == name).first()
+            if not model:
+                return ["Error", f"Модели {name} не существует!"]
+            if not model.is_fitted:
+                return ["Error", f"Модель {name} еще не обучена!"]
+            predictors[name] = model.load()["model"]
+
+        def score(name):
+            try:
+                return predictors[name].predict(X)
+            except (ValueError, TypeError, RuntimeError, IndexError):
+                return None
+
+        # all models read the same feature matrix, trees are evaluated by numpy which releases GIL
+        with ThreadPoolExecutor(max_workers=max(1, min(len(names), app.config['SCORING_THREADS']))) as executor:
+            columns = dict(zip(names, executor.map(score, names)))
+        for name, preds in columns.items():
+            if preds is None:
+                return ["Error", f"Неправильный формат данных для модели {name}, убедитесь, что они соответствуют "
+                                 "данным, на которых обучалась модель"]
+        headers = {"Content-Disposition": f"attachment; filename=predictions.{data_format}"}
+        if y is not None:
+            headers["X-RMSE"] = json.dumps({name: float(rmse(y, preds)) for name, preds in columns.items()})
+        with stage("render"):
+            content, mimetype = write_columns(columns, data_format)
+        return Response(content, mimetype=mimetype, headers=headers)
     except (ValueError, TypeError, RuntimeError):
         return ["Error", "Не удалось получить предсказания. Проверьте корректность введенных данных"]
 
 
+@app.route("/predict_json", methods=["POST"])
+def predict_json():
+    """
+    Making prediction to one or a few rows given in json as {"model": name, "rows": [[...], ...]}
+    Concurrent requests to the same model are predicted together in one batch
+    """
+    try:
+        data = request.json
+        model = Model.query.filter(Model.name == data.get("model")).first()
+        if not model:
+            return ["Error", "Такой модели не существует!"]
+        if not model.is_fitted:
+            return ["Error", "Модель еще не обучена!"]
+        with stage("parse"):
+            X = np.asarray(data.get("rows"), dtype=app.config['FEATURES_DTYPE'])
+        if X.ndim == 1:
+            X = X[None, :]
+        if X.ndim != 2 or X.size == 0:
+            return ["Error", "Добавьте данные для предсказания!"]
+        try:
+            predictor = model.load()["model"]
+            preds = micro_batcher.predict((model.name, X.shape[1]), X, predictor.predict)
+        except (ValueError, TypeError, RuntimeError, IndexError):
+            return ["Error",
+                    "Неправильный формат данных, убедитесь, что они соответствуют данным, на которых обучалась модель "]
+        return ["OK", preds.tolist()]
+    except (ValueError, TypeError, RuntimeError, AttributeError):
+        return ["Error", "Не удалось получить предсказания. Проверьте корректность введенных данных"]
+
+
 @app.route("/get_info_about_model", methods=["GET"])
 def get_info_about_model():
     """
@@ -296,3 +871,11 @@ def get_info_about_model():
         return ["OK", data]
     except (ValueError, TypeError, RuntimeError):
         return ["Error", "Некорректный запрос на получение информации о модели!"]
+
+
+@app.route("/get_cache_info", methods=["GET"])
+def get_cache_info():
+    """
+    Returns counters of the model cache
+    """
+    return ["OK", model_cache.stats()]